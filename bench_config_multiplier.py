@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+######################################
+#
+# Kuklin E.
+# Benchmark for config_multiplier.py.
+# Generates synthetic .ini inputs of several sizes (with "..." ranges, quoted constants and & markers),
+# times parsing, enumeration, rendering and file writing separately and saves combos/sec and peak RSS
+# to a JSON file, so runs on different commits can be compared.
+# Sizes are given as PARAMSxVALUESxSECTIONS, e.g. 6x5x2 - 6 varying parameters with 5 values in 2 sections.
+#
+######################################
+
+import os
+import json
+import time
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+from loguru import logger
+
+import config_multiplier as cm
+
+DEFAULT_SIZES = ['4x5x1', '6x5x2', '8x5x4', '10x4x4']
+
+def make_ini(params: int, values: int, sections: int) -> str:
+    """Returns text of a synthetic .ini file"""
+    lines = []
+    per_section = -(-params // sections)   # ceil
+    for p in range(params):
+        # A single section means an .ini file without section headers
+        if sections > 1 and p % per_section == 0:
+            lines.append(f'[section{p // per_section}]')
+        if p % 3 == 2:
+            # Range of `values` values
+            lines.append(f'range{p} = 0...0.5...{0.5 * (values - 1):g}')
+        elif p % 3 == 1:
+            # Important parameter marked with &
+            lines.append(f'marked{p} = ' + ' '.join(str(v * 10) for v in range(values)) + ' &')
+        else:
+            lines.append(f'list{p} = ' + ' '.join(f'{v / 4:g}' for v in range(values)))
+        if p % 4 == 0:
+            lines.append(f'const{p} = "some text {p}"')
+            lines.append(f'flag{p} = {"true" if p % 8 == 0 else "false"}')
+    return '\n'.join(lines) + '\n'
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+def bench_size(size: str, write_limit: int) -> dict:
+    params, values, sections = map(int, size.split('x'))
+    with tempfile.TemporaryDirectory() as work_dir:
+        ini_file = os.path.join(work_dir, 'input.txt')
+        with open(ini_file, 'w') as f:
+            f.write(make_ini(params, values, sections))
+
+        def parse():
+            section_flag, config = cm.read_config(ini_file)
+            space = cm.CombinationSpace(cm.create_new_dict_to_work(config))
+            return space, cm.option_names(config), cm.OutputTemplate(section_flag, config, space)
+        (space, options, template), parse_time = timed(parse)
+        combinations = space.size
+
+        def enumerate_all():
+            for I, i in space.iter_indices():
+                pass
+        _, enumerate_time = timed(enumerate_all)
+
+        def render_all():
+            for I, i in space.iter_indices():
+                template.render(i)
+                cm.dir_name(I, i, options, space)
+        _, render_time = timed(render_all)
+
+        files = min(write_limit, combinations)
+        out_dir = os.path.join(work_dir, 'out')
+        os.mkdir(out_dir)
+
+        def write_all():
+            for I, i in space.iter_indices(0, files):
+                cm.write_file(os.path.join(out_dir, cm.dir_name(I, i, options, space)), template.render(i))
+        _, write_time = timed(write_all)
+
+    result = {
+        'size': size,
+        'params': params,
+        'values': values,
+        'sections': sections,
+        'combinations': combinations,
+        'parse_sec': parse_time,
+        'enumerate_sec': enumerate_time,
+        'render_sec': render_time,
+        'write_sec': write_time,
+        'written_files': files,
+        'enumerate_combos_per_sec': combinations / enumerate_time if enumerate_time else None,
+        'render_combos_per_sec': combinations / render_time if render_time else None,
+        'write_files_per_sec': files / write_time if write_time else None,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    logger.info(f'{size}: {combinations} combinations, '
+                f'{result["render_combos_per_sec"]:.0f} rendered/s, {result["write_files_per_sec"]:.0f} files/s')
+    return result
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark config_multiplier phases on synthetic inputs')
+    parser.add_argument('sizes', nargs='*', default=DEFAULT_SIZES, help='PARAMSxVALUESxSECTIONS')
+    parser.add_argument('-o', '--output', default='bench_config_multiplier.json', help='JSON file for results')
+    parser.add_argument('-w', '--write-limit', type=int, default=2000, help='max number of files to write per size')
+    args = parser.parse_args()
+
+    results = [bench_size(size, args.write_limit) for size in args.sizes]
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.success(f'Results saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Synthetic collectl logs and a benchmark of nodes_load.py scans.
+# Writes logs of apollo, tesla and tesla-v100/a100 nodes into a temporary directory
+# (or --log-dir to keep them), then times cold and warm scans and saves files/sec,
+# latency percentiles and memory to a JSON file.
+# "Cold" is the first scan after generation with an empty classification cache,
+# the page cache of the OS is not dropped. Peak Python allocations are traced for the cold
+# and every warm scan; the RSS is the high-water mark of the whole benchmark process.
+# Kuklin E.
+
+import os
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+import nodes_load
+
+DEFAULT_NODES = [100, 1000, 10000]
+
+def node_names(count):
+    """Names of `count` nodes: 40% apollo, 50% tesla (some with 3 packed GPU), 10% tesla HPC"""
+    names = []
+    packed = [f'tesla{k}' for k in range(47, 53)]     # keep the 3-GPU nodes among the teslas
+    for k in range(count):
+        kind = k % 10
+        if kind < 4:
+            names.append(f'apollo{k + 1}')
+        elif kind < 9:
+            names.append(packed.pop() if packed and k % 20 == 5 else f'tesla{k + 100}')
+        else:
+            names.append(f'tesla-{"v100" if k % 20 == 9 else "a100"}-{k + 1}')
+    return names
+
+def make_line(name, timestamp, generator):
+    """One line of the collectl log in the format parsed by nodes_load.parse_sample"""
+    meminfo = str(generator.randint(1 << 20, 200 << 20))
+    cpuusrinfo = ','.join(str(generator.randint(0, 90)) for _ in range(4))
+    cpusysinfo = ','.join(str(generator.randint(0, 10)) for _ in range(4))
+    gpuinfo = gpumeminfo = ''
+    if name.startswith('tesla'):
+        rule = nodes_load.REGISTRY.classify(name)
+        if rule and rule[1] == 'packed':
+            gpuinfo = ','.join([str(generator.randint(0, 100)) for _ in range(rule[2])] +
+                               [str(generator.randint(0, 11441)) for _ in range(rule[2])])
+        else:
+            gpuinfo = ','.join(str(generator.randint(0, 100)) for _ in range(8))
+            gpumeminfo = ','.join(str(generator.randint(0, 40960)) for _ in range(8))
+    return ' '.join([str(int(timestamp)), meminfo, '120,340', '12', cpuusrinfo, cpusysinfo,
+                     gpuinfo, gpumeminfo, str(generator.randint(200, 3000)), str(generator.randint(30, 80))])
+
+def generate_logs(log_dir, count, now, max_lines=100, stale=0.1, seed=0):
+    """Writes logs of `count` nodes for the month of `now`; a `stale` fraction of them is older than STALE_TIME"""
+    generator = random.Random(seed)
+    yearmonth = time.strftime("%Y%m", time.localtime(now))
+    os.makedirs(log_dir, exist_ok=True)
+    for name in node_names(count):
+        lines = generator.randint(2, max_lines)
+        modify_time = now - generator.uniform(0, 60)
+        if generator.random() < stale:
+            modify_time = now - nodes_load.STALE_TIME - generator.uniform(1, 3600)
+        path = os.path.join(log_dir, f'{name}-{yearmonth}')
+        with open(path, 'w') as f:
+            f.write('\n'.join(make_line(name, modify_time - 10 * (lines - k), generator) for k in range(lines)) + '\n')
+        os.utime(path, (modify_time, modify_time))
+
+def percentiles(values):
+    values = sorted(values)
+    return {f'p{q}': nodes_load.percentile(values, q) for q in (50, 90, 99)}
+
+def bench_nodes(count, threads, repeat, max_lines, log_dir=None):
+    now = time.time()
+    work_dir = log_dir or tempfile.mkdtemp(prefix='collectl')
+    try:
+        generate_logs(work_dir, count, now, max_lines)
+        nodes_load.REGISTRY.cache.clear()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        results = nodes_load.scan_logs(work_dir, threads, now)
+        cold = time.perf_counter() - start
+        cold_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        # Warm scans are traced as the cold one, so their times are comparable
+        warm = []
+        warm_memory = []
+        tracemalloc.start()
+        for _ in range(repeat):
+            tracemalloc.reset_peak()
+            start = time.perf_counter()
+            nodes_load.scan_logs(work_dir, threads, now)
+            warm.append(time.perf_counter() - start)
+            warm_memory.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    finally:
+        if not log_dir:
+            shutil.rmtree(work_dir)
+
+    result = {
+        'nodes': count,
+        'threads': threads,
+        'files_ok': sum(1 for filename, state, sample in results if state == 'ok'),
+        'files_stale': sum(1 for filename, state, sample in results if state == 'stale'),
+        'cold_sec': cold,
+        'cold_files_per_sec': count / cold,
+        'cold_peak_traced_bytes': cold_memory,
+        'warm_sec': percentiles(warm),
+        'warm_files_per_sec': count / percentiles(warm)['p50'],
+        'warm_peak_traced_bytes': max(warm_memory) if warm_memory else None,
+        # High-water mark of the whole process, including the cases run before; kilobytes on Linux
+        'process_peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    print(f'{count} nodes, {threads} threads: cold {cold * 1000:.1f} ms, '
+          f'warm p50 {result["warm_sec"]["p50"] * 1000:.1f} ms, {result["warm_files_per_sec"]:.0f} files/s')
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark nodes_load scans on synthetic collectl logs')
+    parser.add_argument('nodes', nargs='*', type=int, default=DEFAULT_NODES, help='numbers of nodes')
+    parser.add_argument('-t', '--threads', type=int, nargs='+', default=[1, nodes_load.THREADS],
+                        help='numbers of scan threads')
+    parser.add_argument('-r', '--repeat', type=int, default=10, help='warm scans per case')
+    parser.add_argument('--max-lines', type=int, default=100, help='max lines in a generated log')
+    parser.add_argument('--log-dir', help='generate the logs here and keep them (only with one number of nodes)')
+    parser.add_argument('-o', '--output', default='bench_nodes_load.json', help='JSON file for results')
+    args = parser.parse_args()
+
+    if args.log_dir and len(args.nodes) > 1:
+        parser.error('--log-dir needs one number of nodes')
+    results = [bench_nodes(count, threads, args.repeat, args.max_lines, args.log_dir)
+               for count in args.nodes for threads in args.threads]
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results saved to ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,12 +13,26 @@
 #  i(k-1) = jk mod n(k-1)
 #  ...
 #  i1 = j2 mod n1
+# Constraints between parameters may be declared in lines starting with #%, e.g.:
+# #% dt <= t_end / 10
+# Combinations violating them are skipped as soon as all parameters of the constraint are fixed.
 #
 ######################################
 
+import io
+import ast
 import os
+import json
+import time
+import random
+import struct
+import tarfile
+import hashlib
+import argparse
+from multiprocessing import Pool
 from loguru import logger
-from math import isclose
+from math import sqrt, log, exp
+from decimal import Decimal
 from configparser import ConfigParser
 
 def check_ini_sections(ini_file):
@@ -34,11 +48,15 @@ def check_ini_sections(ini_file):
     if flag:
         with open(ini_file, 'r') as file:
             str_data = file.read()
+        # Constraint lines are Python expressions, they are kept as they are
+        lines = str_data.splitlines(keepends=True)
+        settings = ''.join(line for line in lines if not line.startswith('#%'))
         # Replace parameters if there are no signs of replacement already (for compatibility)
-        if not ('"true"' in str_data or '"false"' in str_data):
-            str_data = str_data.replace('"', '""')
-            str_data = str_data.replace('true', '"true"')
-            str_data = str_data.replace('false', '"false"')
+        if not ('"true"' in settings or '"false"' in settings):
+            lines = [line if line.startswith('#%') else
+                     line.replace('"', '""').replace('true', '"true"').replace('false', '"false"')
+                     for line in lines]
+            str_data = ''.join(lines)
         try:
             # Write the modified file back
             with open(ini_file, 'w') as file:
@@ -68,47 +86,518 @@ def create_new_dict_to_work(config: ConfigParser):
             count += 1
     return indexed_parameters
 
-def write_file(section_flag: bool, cur_dir: str, config: ConfigParser, num_values: list,
-               i: list, indexed_parameters: dict):
+def expand_range(value: str) -> list:
+    """Expands a range into the list of values:
+    start...step...end - values from start to end (inclusive) with the step,
+    lin:start...end...count - count evenly spaced values, start and end included,
+    log:start...end...count - count values evenly spaced on a log scale.
+    The number of values is computed first and every value is calculated from its number,
+    so there is no drift of the accumulated step and the result is the same on every run."""
+    kind, _, value = value.rpartition(':')
+    temp = value.split("...")   # parse by three dots
+    try:
+        if len(temp) != 3:
+            raise ValueError
+        if not kind:
+            # Decimal keeps "0.1" exact, so the count of values includes the end of the range exactly
+            start, step, end = (Decimal(item.strip()) for item in temp)
+            if step == 0:
+                raise ValueError
+            count = max(0, int((end - start) / step) + 1)
+            start, step = float(start), float(step)
+            return [f'{start + k * step:g}' for k in range(count)]
+        start, end, count = float(temp[0]), float(temp[1]), int(temp[2])
+        if count < 1:
+            raise ValueError
+        if count == 1:
+            return [f'{start:g}']
+        if kind == 'lin':
+            return [f'{start + (end - start) * k / (count - 1):g}' for k in range(count)]
+        if kind == 'log' and start > 0 and end > 0:
+            ratio = end / start
+            return [f'{start * ratio ** (k / (count - 1)):g}' for k in range(count)]
+        raise ValueError
+    except (ValueError, ArithmeticError):
+        logger.error(f'Bad range: {kind + ":" if kind else ""}{value}')
+        exit()
+
+class CombinationSpace:
+    """Lazy, random-access view over all combinations of parameter values.
+
+    Combinations are numbered as in the header: the last parameter varies the fastest.
+    Nothing is enumerated in advance, so len() and decoding of a single index are cheap
+    even for spaces with billions of combinations.
+    """
+
+    def __init__(self, indexed_parameters: dict):
+        self.values = []        # list of values for every parameter, in the order of the ini file
+        for value in indexed_parameters.values():
+            if value[0] == '"':
+                # A quoted constant is a single value, it is written "as is"
+                value = [value]
+            elif '...' in value:
+                value = expand_range(value)
+            else:
+                value = value.split(" ")
+            self.values.append(value)
+        self.num_values = [len(value) for value in self.values]     # this is n(k) in the formula
+        # strides[k] - how many combinations pass while the parameter k keeps its value
+        self.strides = [1] * len(self.num_values)
+        for k in range(len(self.num_values) - 2, -1, -1):
+            self.strides[k] = self.strides[k + 1] * self.num_values[k + 1]
+        self.size = self.strides[0] * self.num_values[0] if self.num_values else 0
+        self.constraints = None     # Constraints, used to skip invalid combinations
+
+    def __len__(self):
+        return self.size
+
+    def decode(self, I: int) -> list:
+        """Returns indices of values of every parameter for the combination number I"""
+        if I < 0:
+            I += self.size
+        if not 0 <= I < self.size:
+            raise IndexError(f'combination {I} is out of range')
+        i = [0] * len(self.num_values)
+        for k in range(len(self.num_values) - 1, -1, -1):
+            I, i[k] = divmod(I, self.num_values[k])
+        return i
+
+    def encode(self, i: list) -> int:
+        """Returns the combination number I for indices of values of every parameter"""
+        return sum(i[k] * self.strides[k] for k in range(len(i)))
+
+    def combination(self, i: list) -> tuple:
+        """Converts indices of values to the values themselves"""
+        return tuple(self.values[k][i[k]] for k in range(len(i)))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self.combination(i) for I, i in self.iter_indices(*item.indices(self.size))]
+        return self.combination(self.decode(item))
+
+    def __iter__(self):
+        for I, i in self.iter_indices():
+            yield self.combination(i)
+
+    def iter_indices(self, start: int = 0, stop: int = None, step: int = 1):
+        """Streams (I, indices) pairs, indices as a tuple; consecutive combinations are counted like an odometer"""
+        if stop is None:
+            stop = self.size
+        if step != 1:
+            for I in range(start, stop, step):
+                yield I, tuple(self.decode(I))
+            return
+        if start >= stop:
+            return
+        i = self.decode(start)
+        last = len(i) - 1
+        for I in range(start, stop):
+            # The odometer list is changed in place, every consumer gets its own copy
+            yield I, tuple(i)
+            # Increment the last index and carry over to the previous ones
+            k = last
+            while k >= 0:
+                i[k] += 1
+                if i[k] < self.num_values[k]:
+                    break
+                i[k] = 0
+                k -= 1
+
+    def iter_pruned(self, start: int, stop: int):
+        """Streams valid (I, indices) pairs; as soon as a constraint fails on the parameters
+        fixed so far, all combinations sharing them are skipped at once"""
+        if start >= stop:
+            return
+        i = self.decode(start)
+        last = len(i) - 1
+        I = start
+        level = 0       # constraints on parameters before this one are already checked
+        while I < stop:
+            failed = self.constraints.check(i, level)
+            if failed is None:
+                yield I, tuple(i)
+                I += 1
+                k = last
+                while k >= 0:
+                    i[k] += 1
+                    if i[k] < self.num_values[k]:
+                        break
+                    i[k] = 0
+                    k -= 1
+                level = k
+            else:
+                # Jump to the next value of the parameter that made the combination invalid
+                I = (I // self.strides[failed] + 1) * self.strides[failed]
+                if I >= stop:
+                    return
+                previous, i = i, self.decode(I)
+                level = next(k for k in range(len(i)) if i[k] != previous[k])
+
+    def iter_selection(self, selection):
+        """Streams (I, indices) pairs for a range of I or for a sorted list of I"""
+        if isinstance(selection, range) and selection.step == 1:
+            if self.constraints:
+                yield from self.iter_pruned(selection.start, selection.stop)
+            else:
+                yield from self.iter_indices(selection.start, selection.stop)
+        else:
+            for I in selection:
+                i = self.decode(I)
+                if not self.constraints or self.constraints.check(i) is None:
+                    yield I, tuple(i)
+
+def sample_uniform(space: CombinationSpace, samples: int, seed: int) -> list:
+    """Random combinations without repetitions; O(samples), the space is not walked"""
+    generator = random.Random(seed)
+    if 2 * samples >= space.size:
+        # A small space, a plain sample is faster than rejecting repeats
+        return sorted(generator.sample(range(space.size), min(samples, space.size)))
+    # randrange works with sizes beyond sys.maxsize, unlike len() and sample() of a range
+    chosen = set()
+    while len(chosen) < samples:
+        chosen.add(generator.randrange(space.size))
+    return sorted(chosen)
+
+def sample_latin_hypercube(space: CombinationSpace, samples: int, seed: int) -> list:
+    """Latin hypercube: every parameter is split into `samples` strata, each stratum is used once"""
+    if space.size == 0:
+        return []
+    generator = random.Random(seed)
+    columns = []
+    for n in space.num_values:
+        strata = list(range(samples))
+        generator.shuffle(strata)
+        columns.append([int((stratum + generator.random()) * n / samples) for stratum in strata])
+    # Parameters with less values than samples give repeated combinations, drop them
+    return sorted({space.encode([column[s] for column in columns]) for s in range(samples)})
+
+def shard(space: CombinationSpace, k: int, shards: int) -> range:
+    """Contiguous part k of `shards` equal parts of the space"""
+    return range(space.size * k // shards, space.size * (k + 1) // shards)
+
+def option_names(config: ConfigParser) -> list:
+    """Returns names of all parameters in the same order as in create_new_dict_to_work"""
+    return [option for section in config.sections() for option, value in config.items(section)]
+
+def dir_name(I: int, i: list, options: list, space: CombinationSpace) -> str:
+    # Prepare a folder name with varying variables
+    cur_dir = f'conf{str(I)}_'
+    for k, option in enumerate(options):
+        if space.num_values[k] > 1:
+            cur_dir += option + "=" + space.values[k][i[k]]
+    return cur_dir[:100]    # cut just in case
+
+# Functions allowed in constraint expressions
+CONSTRAINT_FUNCTIONS = {'abs': abs, 'min': min, 'max': max, 'round': round,
+                        'sqrt': sqrt, 'log': log, 'exp': exp}
+CONSTRAINT_NODES = (ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare, ast.IfExp, ast.Call,
+                    ast.Name, ast.Load, ast.Constant, ast.boolop, ast.operator, ast.unaryop, ast.cmpop)
+
+def read_constraints(ini_file: str) -> list:
+    """Returns constraint expressions, declared in the ini file in lines like: #% dt <= t_end / 10"""
+    with open(ini_file, 'r') as file:
+        return [line[2:].strip() for line in file if line.startswith('#%')]
+
+def convert_value(value: str):
+    # Numbers are compared as numbers, everything else as strings without quotes
+    try:
+        return float(value)
+    except ValueError:
+        return value.strip('"')
+
+class Constraints:
+    """Compiled constraint expressions between parameters.
+
+    Every expression is checked at the level of its last parameter, i.e. as soon as all
+    parameters it uses are fixed.
+    """
+
+    def __init__(self, expressions: list, options: list, space: CombinationSpace):
+        self.values = [[convert_value(value) for value in values] for values in space.values]
+        self.rules = []     # (level, expression, [(name, parameter number)])
+        for expression in expressions:
+            try:
+                tree = ast.parse(expression, mode='eval')
+            except SyntaxError:
+                logger.error(f'Bad constraint: {expression}')
+                exit()
+            names = []
+            for node in ast.walk(tree):
+                if not isinstance(node, CONSTRAINT_NODES):
+                    logger.error(f'Unsupported syntax in constraint: {expression}')
+                    exit()
+                if isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and
+                                                       node.func.id in CONSTRAINT_FUNCTIONS):
+                    logger.error(f'Unsupported function in constraint: {expression}')
+                    exit()
+                if isinstance(node, ast.Name) and node.id not in CONSTRAINT_FUNCTIONS:
+                    if node.id not in options:
+                        logger.error(f'Unknown parameter {node.id} in constraint: {expression}')
+                        exit()
+                    names.append((node.id, options.index(node.id)))
+            level = max((k for name, k in names), default=0)
+            self.rules.append((level, expression, names))
+        # Check the constraints on the first parameters first, they prune more
+        self.rules.sort(key=lambda rule: rule[0])
+        self.compile()
+
+    def compile(self):
+        self.codes = [compile(expression, '<constraint>', 'eval') for level, expression, names in self.rules]
+
+    def __getstate__(self):
+        # Code objects cannot be pickled, so worker processes compile the expressions again
+        state = self.__dict__.copy()
+        del state['codes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+    def check(self, i: list, level: int = 0):
+        """Returns the parameter number at which the combination becomes invalid, or None"""
+        for (rule_level, expression, names), code in zip(self.rules, self.codes):
+            if rule_level < level:
+                continue
+            scope = {name: self.values[k][i[k]] for name, k in names}
+            try:
+                valid = eval(code, {'__builtins__': {}, **CONSTRAINT_FUNCTIONS}, scope)
+            except (ArithmeticError, TypeError, ValueError):
+                valid = False
+            if not valid:
+                return rule_level
+        return None
+
+class OutputTemplate:
+    """Output file compiled once per run: the constant text with slots for the varying parameters"""
+
+    def __init__(self, section_flag: bool, config: ConfigParser, space: CombinationSpace):
+        self.space = space
+        self.parts = []     # pieces of the output; slots are filled in by render()
+        self.slots = []     # (position in parts, parameter number)
+        text = ''
+        count = 0
+        # Then we take the name of the parameter from $parameters_sections, and the value of the parameter
+        # from 2D indexed parameters[current config line][value number in the list of values of the current line]
+        for section in config.sections():
+            if section_flag:
+                text += f'[{section.title()}]\n'
+            for option, value in config.items(section):
+                # If the variable does not vary (i.e. it has a single value) then
+                # if the variable contains true we write =true ,
+                # or if the variable contains false we write =false ,
+                # or then it is a constant and is written in quotes "as is"
+                if space.num_values[count] == 1:
+                    if "true" in value.lower():
+                        text += f'{option}=true\n'
+                    elif "false" in value.lower():
+                        text += f'{option}=false\n'
+                    else:
+                        text += f'{option}={value}\n'
+                else:
+                    # or leave a slot for the corresponding numerical parameters
+                    self.parts.append(text + f'{option}=')
+                    self.slots.append((len(self.parts), count))
+                    self.parts.append('')
+                    text = '\n'
+                count += 1
+            text += '\n'
+        self.parts.append(text)
+
+    def render(self, i: list) -> str:
+        parts = self.parts.copy()
+        values = self.space.values
+        for position, k in self.slots:
+            parts[position] = values[k][i[k]]
+        return ''.join(parts)
+
+def save_file(cur_dir: str, text: str):
+    """Writes input.txt into the directory, raises IOError on failure"""
     if not os.path.exists(cur_dir):
         os.mkdir(cur_dir, 0o755)
-    handle = open(os.path.join(cur_dir, "input.txt"), "w+")
-    if not handle:
+    with open(os.path.join(cur_dir, "input.txt"), "w") as handle:
+        handle.write(text)
+
+def write_file(cur_dir: str, text: str):
+    try:
+        save_file(cur_dir, text)
+    except IOError:
         logger.error('Cannot open new file. Exiting...')
         exit()
+
+_worker = {}    # state of a worker process, filled by init_worker
+
+def init_worker(space: CombinationSpace, options: list, template: OutputTemplate):
+    _worker['space'] = space
+    _worker['options'] = options
+    _worker['template'] = template
+
+def write_chunk(chunk) -> int:
+    """Writes a chunk of the selection in a worker process, returns the number of files"""
+    space, options, template = _worker['space'], _worker['options'], _worker['template']
     count = 0
-    # Then we take the name of the parameter from $parameters_sections, and the value of the parameter
-    # from 2D indexed parameters[current config line][value number in the list of values of the current line]
-    for section in config.sections():
-        if section_flag:
-            handle.write(f'[{section.title()}]\n')
-        for option, value in config.items(section):
-        # If the variable does not vary and is not an array (i.e. numeric values) then
-        # if the variable contains true we write =true ,
-        # or if the variable contains false we write =false ,
-        # or then it is a constant and is written in quotes "as is"
-            if num_values[count] == 1 and type(value) is not list:
-                if "true" in value.lower():
-                    handle.write(f'{option}=true\n')
-                elif "false" in value.lower():
-                    handle.write(f'{option}=false\n')
-                else:
-                    handle.write(f'{option}={value}\n')
-            else:
-                # or take the corresponding numerical parameters
-                handle.write(f'{option}={indexed_parameters[count][i[count]]}\n')
-            count += 1
-        handle.write("\n")
-    handle.close()
+    for I, i in space.iter_selection(chunk):
+        # exit() would kill the worker and leave the parent waiting, the error is raised to the parent instead
+        save_file(dir_name(I, i, options, space), template.render(i))
+        count += 1
+    return count
 
-def main():
-    ini_file = "input.txt"  # default
-    if not os.path.exists(ini_file):
-        logger.error('Cannot open config file')
+def render_chunk(chunk) -> list:
+    """Renders a chunk of the selection in a worker process"""
+    space, options, template = _worker['space'], _worker['options'], _worker['template']
+    return [(I, dir_name(I, i, options, space), template.render(i)) for I, i in space.iter_selection(chunk)]
+
+def selection_size(selection) -> int:
+    """Number of selected I; len() of a range fails beyond sys.maxsize"""
+    if isinstance(selection, range):
+        return max(0, (selection.stop - selection.start + selection.step - 1) // selection.step)
+    return len(selection)
+
+def split_selection(selection, jobs: int) -> list:
+    # Shard the selected I into chunks small enough to balance the load between workers
+    size = selection_size(selection)
+    chunk = max(1, min(1000, size // (jobs * 8)))
+    return [selection[start:start + chunk] for start in range(0, size, chunk)]
+
+def write_parallel(space: CombinationSpace, selection, options: list, template: OutputTemplate, jobs: int):
+    chunks = split_selection(selection, jobs)
+    checked = 0
+    done = 0
+    with Pool(jobs, initializer=init_worker, initargs=(space, options, template)) as pool:
+        # imap keeps the order of chunks, so the progress is reported deterministically
+        try:
+            for chunk, count in zip(chunks, pool.imap(write_chunk, chunks)):
+                checked += len(chunk)
+                done += count
+                logger.info(f'Processed combinations: {checked}/{selection_size(selection)}, dirs: {done}')
+        except IOError as error:
+            logger.error(f'Cannot open new file: {error}. Exiting...')
+            exit()
+
+def load_manifest(manifest_file: str) -> dict:
+    """Returns {content hash: {"dir": directory, "index": I}} of the previous run, or empty dict"""
+    if not os.path.exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file, 'r') as f:
+            return json.load(f)['combinations']
+    except (IOError, ValueError, KeyError):
+        logger.error('Manifest file corrupted')
+        exit()
+
+def write_incremental(space: CombinationSpace, selection, options: list, template: OutputTemplate,
+                      manifest_file: str, jobs: int = 1):
+    """Writes only the combinations that are absent in the manifest of the previous run;
+    entries of combinations outside the selection (other shards or samples) are kept as they are"""
+    old = load_manifest(manifest_file)
+    new = {}
+    pending = []    # combinations to write: (hash, I, directory, text)
+    for I, cur_dir, text in iter_rendered(space, selection, options, template, jobs):
+        digest = hashlib.sha1(text.encode()).hexdigest()
+        if digest in new:
+            continue        # duplicated values give the same file
+        if digest in old:
+            # Unchanged combination, leave its directory alone even if I has changed
+            new[digest] = {'dir': old[digest]['dir'], 'index': I}
+        else:
+            new[digest] = None
+            pending.append((digest, I, cur_dir, text))
+
+    # Combinations beyond the end of the space are gone, not just unselected
+    selected = selection if isinstance(selection, range) else set(selection)
+    carried = {digest: entry for digest, entry in old.items()
+               if digest not in new and entry['index'] < space.size and entry['index'] not in selected}
+
+    # Directories of the previous run that stay in the sweep must not be overwritten
+    kept_dirs = {entry['dir'] for entry in new.values() if entry} | {entry['dir'] for entry in carried.values()}
+    for digest, I, cur_dir, text in pending:
+        if cur_dir in kept_dirs:
+            cur_dir = cur_dir[:91] + '_' + digest[:8]
+        write_file(cur_dir, text)
+        new[digest] = {'dir': cur_dir, 'index': I}
+        logger.info(f'Processed dir: {cur_dir}')
+
+    # A directory rewritten under the same name, e.g. after a change of a constant, is not removed
+    written_dirs = {entry['dir'] for entry in new.values()}
+    removed = [entry['dir'] for digest, entry in old.items()
+               if digest not in new and digest not in carried and entry['dir'] not in written_dirs]
+    for cur_dir in removed:
+        logger.warning(f'Not in the sweep anymore: {cur_dir}')
+    logger.info(f'New: {len(pending)}, unchanged: {len(new) - len(pending)}, removed: {len(removed)}, '
+                f'outside the selection: {len(carried)}')
+
+    new.update(carried)
+    try:
+        with open(manifest_file, 'w') as f:
+            json.dump({'combinations': new}, f)
+    except IOError:
+        logger.error('Cannot write the manifest file')
         exit()
+
+def iter_rendered(space: CombinationSpace, selection, options: list, template: OutputTemplate, jobs: int = 1):
+    """Streams (I, directory, text) of the selected combinations, rendered by a process pool if jobs > 1"""
+    if jobs > 1:
+        with Pool(jobs, initializer=init_worker, initargs=(space, options, template)) as pool:
+            for rendered in pool.imap(render_chunk, split_selection(selection, jobs)):
+                yield from rendered
     else:
-        logger.success('Config file was found')
+        for I, i in space.iter_selection(selection):
+            yield I, dir_name(I, i, options, space), template.render(i)
+
+# Index of a packed sweep: sorted records of (I, offset of the tar header of its input.txt);
+# I is stored as two 64-bit halves, spaces of sampled sweeps easily exceed 2^64 combinations
+INDEX_RECORD = struct.Struct('<QQQ')
+INDEX_LIMIT = 1 << 128
 
+def write_packed(rendered, pack_file: str):
+    """Writes all configs into one uncompressed tar and a binary index next to it"""
+    mtime = time.time()
+    count = 0
+    try:
+        with open(pack_file, 'wb') as handle, open(pack_file + '.idx', 'wb') as index, \
+                tarfile.open(fileobj=handle, mode='w', format=tarfile.GNU_FORMAT) as tar:
+            for I, cur_dir, text in rendered:
+                data = text.encode()
+                info = tarfile.TarInfo(cur_dir + '/input.txt')
+                info.size = len(data)
+                info.mtime = mtime
+                if I >= INDEX_LIMIT:
+                    logger.error(f'Combination {I} is too large for the index of the packed file')
+                    exit()
+                index.write(INDEX_RECORD.pack(I >> 64, I & (1 << 64) - 1, handle.tell()))
+                tar.addfile(info, io.BytesIO(data))
+                count += 1
+    except IOError:
+        logger.error('Cannot write the packed file')
+        exit()
+    logger.info(f'Packed {count} configs into {pack_file}')
+
+def read_packed(pack_file: str, I: int):
+    """Returns (directory, text) of the combination I without unpacking the whole file"""
+    with open(pack_file + '.idx', 'rb') as index:
+        # Binary search over fixed-size records
+        low, high = 0, os.fstat(index.fileno()).st_size // INDEX_RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            index.seek(middle * INDEX_RECORD.size)
+            upper, lower, offset = INDEX_RECORD.unpack(index.read(INDEX_RECORD.size))
+            number = upper << 64 | lower
+            if number == I:
+                break
+            if number < I:
+                low = middle + 1
+            else:
+                high = middle
+        else:
+            raise KeyError(f'combination {I} is not in {pack_file}')
+    with tarfile.open(pack_file, 'r') as tar:
+        tar.fileobj.seek(offset)
+        member = tarfile.TarInfo.fromtarfile(tar)
+        text = tar.extractfile(member).read().decode()
+    return os.path.dirname(member.name), text
+
+def read_config(ini_file: str):
+    """Returns the section flag and the parsed config"""
     section_flag = check_ini_sections(ini_file)
     # Read file directly or add a fiction section
     if section_flag:
@@ -121,59 +610,94 @@ def main():
         config = ConfigParser()
         config.optionxform=str
         config.read_string(config_string)
+    return section_flag, config
+
+def prepare_sweep(ini_file: str):
+    """Returns the combination space with its constraints, option names and output template of the .ini file"""
+    section_flag, config = read_config(ini_file)
 
     # Create a new dictionary of parameter values with numeric keys instead of parameter names
     indexed_parameters = create_new_dict_to_work(config)
 
-    num_params = len(indexed_parameters)    # the number of parameters, this is the "k" in the formula
-    num_values = []     # array of counts of values for each parameter
-    combinations = 1    # count the number of combinations meanwhile
-
-    # Go through and make some changes
-    for key, value in indexed_parameters.items():
-        if value[0] != '"':
-            if '...' in value:
-                temp = value.split("...")   # parse by three dots
-                value = []
-                range_value = float(temp[0])
-                # Do not use direct equality comparison for float
-                while isclose(range_value, float(temp[2])) or range_value < float(temp[2]):
-                    value.append(f'{range_value:g}')
-                    range_value += float(temp[1])
-                indexed_parameters[key] = value
-                temp = value
-            else:
-                temp = value.split(" ")
-                indexed_parameters[key] = temp
-        else:
-            temp = value
-        # len(temp) is the number of values of the current parameter
-        combinations *= len(temp)       # so, this is the number of combinations in I
-        num_values.append(len(temp))    # number of values for each parameter
-
-    # Start iterating over combinations
-    j = [0] * (num_params + 1)  # div - quotient with dropped remainder, J[k] = J[k+1] div nk
-    i = [0] * num_params        # mod - the remainder of the division
-    # "I" is a number of combination
-    for I in range(combinations):
-        j[num_params] = I
-        for p in range(num_params - 1, 0, -1):
-            i[p] = j[p + 1] % num_values[p]         # mod
-            j[p] = int(j[p + 1] / num_values[p])    # div
-        i[0] = j[1] % num_values[0]     # the first element, this completes the search for combination indices
-
-        # Prepare a folder name with varying variables
-        cur_dir = f'conf{str(I)}_'
-        count = 0
-        for section in config.sections():
-            for option, value in config.items(section):
-                if num_values[count] > 1:
-                    cur_dir += option + "=" + indexed_parameters[count][i[count]]
-                count += 1
-        cur_dir = cur_dir[:100]         # cut just in case
+    space = CombinationSpace(indexed_parameters)
+    options = option_names(config)
+    template = OutputTemplate(section_flag, config, space)
+    expressions = read_constraints(ini_file)
+    if expressions:
+        space.constraints = Constraints(expressions, options, space)
+        logger.info(f'Constraints: {len(expressions)}')
+    return space, options, template
 
-        write_file(section_flag, cur_dir, config, num_values, i, indexed_parameters)
-        logger.info(f'Processed dir: {cur_dir}')
+def main():
+    parser = argparse.ArgumentParser(description='Generate configuration files for all combinations of parameters')
+    parser.add_argument('ini_file', nargs='?', default='input.txt', help='input .ini file (default: input.txt)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes')
+    parser.add_argument('-m', '--manifest', nargs='?', const='manifest.json',
+                        help='write only combinations missing in this manifest (default: manifest.json)')
+    parser.add_argument('-p', '--pack', help='write all configs into this tar file instead of directories')
+    parser.add_argument('-u', '--unpack', type=int, metavar='I', help='extract the combination I from the --pack file')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--sample', type=int, metavar='N', help='write N random combinations')
+    mode.add_argument('--lhs', type=int, metavar='N', help='write N combinations of a Latin hypercube')
+    mode.add_argument('--shard', metavar='K/N', help='write part K (counting from 0) of N equal parts')
+    parser.add_argument('--seed', type=int, default=0, help='seed for --sample and --lhs (default: 0)')
+    args = parser.parse_args()
+
+    if args.manifest and args.pack:
+        parser.error('--manifest cannot be used with --pack')
+    if args.unpack is not None:
+        if not args.pack:
+            parser.error('--unpack requires --pack')
+        try:
+            cur_dir, text = read_packed(args.pack, args.unpack)
+        except (IOError, KeyError, tarfile.TarError) as error:
+            logger.error(f'Cannot unpack the config: {error}')
+            exit()
+        write_file(cur_dir, text)
+        logger.success(f'Unpacked dir: {cur_dir}')
+        return
+
+    ini_file = args.ini_file
+    if not os.path.exists(ini_file):
+        logger.error('Cannot open config file')
+        exit()
+    else:
+        logger.success('Config file was found')
+
+    space, options, template = prepare_sweep(ini_file)
+
+    # Choose the combinations to write, the directory names keep their original numbers I
+    if args.sample is not None:
+        if args.sample < 1:
+            parser.error('--sample N must be at least 1')
+        selection = sample_uniform(space, args.sample, args.seed)
+    elif args.lhs is not None:
+        if args.lhs < 1:
+            parser.error('--lhs N must be at least 1')
+        selection = sample_latin_hypercube(space, args.lhs, args.seed)
+    elif args.shard:
+        try:
+            k, shards = map(int, args.shard.split('/'))
+        except ValueError:
+            parser.error('--shard must look like K/N')
+        if not 0 <= k < shards:
+            parser.error('--shard K must be in range 0 <= K < N')
+        selection = shard(space, k, shards)
+    else:
+        selection = range(space.size)
+
+    if args.pack:
+        write_packed(iter_rendered(space, selection, options, template, args.jobs), args.pack)
+    elif args.manifest:
+        write_incremental(space, selection, options, template, args.manifest, args.jobs)
+    elif args.jobs > 1:
+        write_parallel(space, selection, options, template, args.jobs)
+    else:
+        # "I" is a number of combination, i - indices of values of every parameter in it
+        for I, i in space.iter_selection(selection):
+            cur_dir = dir_name(I, i, options, space)
+            write_file(cur_dir, template.render(i))
+            logger.info(f'Processed dir: {cur_dir}')
 
     # Finally we finished
     logger.success('Finished')
@@ -182,4 +706,3 @@ def main():
 if __name__ == '__main__':
     main()
 
-
@@ -5,9 +5,113 @@
 
 from os.path import isfile, join, getsize
 import os
+import sys
 import time
 import glob
 import re
+import configparser
+from configparser import ConfigParser
+import select
+import socket
+import socketserver
+import http.server
+import struct
+import json
+import argparse
+import threading
+import ctypes
+import ctypes.util
+from array import array
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
+
+COLLECTL_DIR = '/home2/collectl/'
+SOCKET_PATH = '/tmp/nodes_load.sock'
+STALE_TIME = 240        # the file is too old if it is unmodified for 4 minutes
+TAIL_SIZE = 65536       # how much of an existing log the daemon reads at start
+TAIL_BLOCK = 4096       # the last line is read with one block of this size
+THREADS = 16            # threads scanning the logs
+HISTORY_SIZE = 720      # samples kept for every node by the daemon
+METRICS = ('cpu_load', 'mem_amount', 'gpu_load', 'gpu_mem_amount')
+PARTITION_METRICS = ('cpu_load', 'mem_load', 'mem_amount', 'gpu_load', 'gpu_mem_load', 'gpu_mem_amount')
+VIEWS = {'1m': 60, '5m': 300, '1h': 3600}   # bucket sizes of downsampled views, seconds
+
+# Partitions of the cluster in the order of the output.
+# mem_total, gpu_mem_total - capacity of the partition, MB;
+# nodes - patterns of the log file names (matched from the start), one per line, each may be followed
+# by the GPU layout of these nodes: none, separate (default; loads in the GPU field, memory in the
+# GPU memory field) or packed:N (N loads followed by N memory amounts in the GPU field).
+# The first matching pattern wins.
+DEFAULT_REGISTRY = """
+[teslaHPC]
+# Tesla HPC
+# Mem: 393216 + 385024 + 257024 = 1_035_264
+# GPU: 32768 x 8 + 40960 x 8 + 40960 x 2 = 671_744
+mem_total = 1035264
+gpu_mem_total = 671744
+nodes = tesla-v100
+        tesla-a100
+        tesla-a101
+
+[apollos]
+# Apollo 1-36
+# 262144 x 16 + 393216 x 20 = 12_058_624
+mem_total = 12058624
+gpu_mem_total = 1
+nodes = apollo none
+
+[teslas]
+# Tesla 1-51
+# Mem: 20 x 49152 + 10 x 196608 + 13 x 98304 + 5 x 65536 + 4 x 98304 = 4_947_968
+# GPU: 11441 x 3 x 6 + 6067 x 8 x 14 + 6067 x 6 = 205 938 + 679 504 + 36 402 = 921_844
+mem_total = 4947968
+gpu_mem_total = 921844
+# This nodes have only 3 GPU: gpu_load[0-2] - load, gpu_load[3-5] - memory
+nodes = tesla(47|48|49|50|51|52) packed:3
+        tesla\\d
+"""
+
+class Registry:
+    """Partitions and rules to classify nodes by the names of their log files"""
+
+    def __init__(self, text):
+        config = ConfigParser()
+        config.optionxform = str
+        try:
+            config.read_string(text)
+            self.partitions = {}      # name: (mem_total, gpu_mem_total)
+            self.rules = []             # (partition, layout, number of GPU for packed layout)
+            patterns = []
+            for name in config.sections():
+                section = config[name]
+                self.partitions[name] = (int(section['mem_total']), int(section['gpu_mem_total']))
+                for rule in section['nodes'].split('\n'):
+                    if not rule.strip():
+                        continue
+                    pattern, _, layout = rule.strip().partition(' ')
+                    layout, _, gpus = (layout.strip() or 'separate').partition(':')
+                    if layout not in ('none', 'separate', 'packed') or (layout == 'packed') != bool(gpus):
+                        raise ValueError('bad GPU layout: ' + rule)
+                    re.compile(pattern)
+                    patterns.append(f'(?P<r{len(self.rules)}>{pattern})')
+                    self.rules.append((name, layout, int(gpus or 0)))
+            # One regular expression for all rules, the first matching alternative wins
+            self.dispatch = re.compile('|'.join(patterns))
+        except (KeyError, ValueError, re.error, configparser.Error) as error:
+            sys.exit('Bad partitions registry: ' + str(error))
+        self.cache = {}     # filename: rule or None
+
+    def classify(self, filename):
+        """Returns (partition, layout, GPU count) of the node, or None if the node is unknown"""
+        try:
+            return self.cache[filename]
+        except KeyError:
+            match = self.dispatch.match(filename)
+            rule = self.rules[int(match.lastgroup[1:])] if match else None
+            self.cache[filename] = rule
+            return rule
+
+REGISTRY = Registry(DEFAULT_REGISTRY)
 
 class nodeinfo:
     def __init__(self, cpu_load=0, mem_load=0, mem_amount=0, gpu_load=0, gpu_mem_load=0, gpu_mem_amount=0, init=False):
@@ -18,16 +122,17 @@ class nodeinfo:
         self.gpu_mem_load = gpu_mem_load
         self.gpu_mem_amount = gpu_mem_amount
         self.init = init
+        self.count = 0
+        self.cpu_sum = 0
+        self.gpu_sum = 0
     def update(self, cpu_load, mem_amount, gpu_load, gpu_mem_amount):
-        # Calc average cpu load and total memory amount
-        if self.init:
-            self.cpu_load = int ((self.cpu_load + cpu_load)*0.5 )
-            self.gpu_load = int ((self.gpu_load + gpu_load)*0.5 )
-        else:
-            # The very first values
-            self.cpu_load = int (cpu_load)
-            self.gpu_load = int (gpu_load)
-            self.init = True
+        # Calc average cpu load over all nodes and total memory amount
+        self.count += 1
+        self.cpu_sum += cpu_load
+        self.gpu_sum += gpu_load
+        self.cpu_load = int (self.cpu_sum / self.count)
+        self.gpu_load = int (self.gpu_sum / self.count)
+        self.init = True
         self.cpu_load = self.check_percent(self.cpu_load)
         self.mem_amount += mem_amount
         self.gpu_load = self.check_percent(self.gpu_load)
@@ -49,62 +154,41 @@ class nodeinfo:
         output = ",".join([str(self.cpu_load), str(self.mem_load), str(self.mem_amount), str(self.gpu_load), str(self.gpu_mem_load), str(self.gpu_mem_amount)])
         return output
 
-def get_info():
-    """Function gets node statistics"""
-    
-    # Node params:
-    # Tesla HPC
-    # Mem: 393216 + 385024 + 257024 = 1_035_264
-    # GPU: 32768 x 8 + 40960 x 8 + 40960 x 2 = 671_744
-    mem_total_hpc = 1035264
-    gpu_mem_total_hpc = 671744
-    # Apollo 1-36
-    # 262144 x 16 + 393216 x 20 = 12_058_624
-    mem_total_apollo = 12058624
-    gpu_mem_total_apollo = 1
-    # Tesla 1-51
-    # Mem: 20 x 49152 + 10 x 196608 + 13 x 98304 + 5 x 65536 + 4 x 98304 = 4_947_968
-    # GPU: 11441 x 3 x 6 + 6067 x 8 x 14 + 6067 x 6 = 205 938 + 679 504 + 36 402 = 921_844
-    mem_total_tesla = 4947968
-    gpu_mem_total_tesla = 921844
+def read_last_line(path):
+    """Returns the last line of the file"""
+    # Read the tail of the file with one block read, a bigger block is read only if the line is longer
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        block = TAIL_BLOCK
+        while True:
+            start = max(0, size - block)
+            f.seek(start)
+            data = f.read(size - start)
+            # The last byte is the end of the last line itself
+            end = data.rfind(b'\n', 0, len(data) - 1)
+            if end >= 0 or start == 0:
+                return data[end + 1:].decode(errors='replace').rstrip('\n')
+            block *= 4
 
-    # Create classes for partitions
-    teslaHPC = nodeinfo()
-    apollos = nodeinfo()
-    teslas = nodeinfo()
-
-    # Get a list of all files corresponding to current date
-    yearmonth = time.strftime("%Y%m")
-    os.chdir('/home2/collectl/')
-    filelist = glob.glob('*' + yearmonth, recursive=False)
-    time_now = time.time()        # fix the current time to check whether log files are outdated
+def parse_sample(filename, line):
+    """Parses a collectl line of the node, returns (partition, cpu_load, mem_amount, gpu_load, gpu_mem_amount)
+    or None if the line is broken or the node is unknown"""
+    rule = REGISTRY.classify(filename)
+    if rule is None:
+        return None
+    partition, layout, gpu_count = rule
 
-    for filename in filelist:
-        modify_time = os.path.getmtime(filename)
-        if time_now - modify_time > 240:
-            continue        # the file is too old (4 minutes unmodified), throw it away
-
-        try:
-            # Seek for the file end, read last line in bytes, and decode
-            with open(filename, 'rb') as f:
-                f.seek(-2, os.SEEK_END)
-                while f.read(1) != b'\n':
-                    f.seek(-2, os.SEEK_CUR)
-                line = f.readline().decode()
-                line = line.rstrip('\n')
-                fields = line.split(" ")
-        except IOError:
-            continue
+    fields = line.split(" ")
+    if len(fields) < 10:
+        return None
+        # print("Bad file format: %s" % filename)
+        # quit()
 
-        if len(fields) < 8:
-            continue
-            # print("Bad file format: %s" % filename)
-            # quit()
-
-        (timeinfo, meminfo, netinfo, nfsinfo,
-         cpuusrinfo, cpusysinfo, gpuinfo, gpumeminfo,
-         wattsinfo, tempinfo) = fields[:10]
+    (timeinfo, meminfo, netinfo, nfsinfo,
+     cpuusrinfo, cpusysinfo, gpuinfo, gpumeminfo,
+     wattsinfo, tempinfo) = fields[:10]
 
+    try:
         # CPU load: cpuusrinfo & cpusysinfo first element is already the average value
         if cpuusrinfo:
             cpu_user_load = cpuusrinfo.split(",")
@@ -122,80 +206,523 @@ def get_info():
         else:
             mem_amount = 0
 
-        # Checking start of filename: tesla HPC, apollo, tesla, and updating the corresponding class
-        match = re.match(r"apollo", filename)
-        if match:
-            apollos.update(cpu_load, mem_amount, 0, 0)
-            
-        is_v100 = re.match(r"tesla-v100", filename)
-        is_a100 = re.match(r"tesla-a100", filename)
-        is_a101 = re.match(r"tesla-a101", filename)
-        if is_v100 or is_a101 or is_a100:
+        gpu_load = 0
+        gpu_mem_amount = 0
+        if layout == 'packed':
+            # GPU load and memory in one field: gpu_load[0:N] - load, gpu_load[N:2N] - memory
+            if gpuinfo:
+                gpu_load = gpuinfo.split(",")
+                gpu_load = list(map(int, gpu_load))
+                gpu_mem_amount = sum(gpu_load[gpu_count:2 * gpu_count])
+                gpu_load = int (sum(gpu_load[:gpu_count]) / gpu_count)
+        elif layout == 'separate':
             # GPU load
             if gpuinfo:
                 gpu_load = gpuinfo.split(",")
                 gpu_load = list(map(int, gpu_load))
                 gpu_count = len(gpu_load)
                 gpu_load = int (sum(gpu_load) / gpu_count)
-            else:
-                gpu_load = 0
             # GPU memory
             if gpumeminfo:
                 gpu_mem_amount = gpumeminfo.split(",")              # string to list
                 gpu_mem_amount = list(map(int, gpu_mem_amount))     # string list to int list
                 gpu_mem_amount = sum(gpu_mem_amount)                # sum of elements
-            else:
-                gpu_mem_amount = 0
-            teslaHPC.update(cpu_load, mem_amount, gpu_load, gpu_mem_amount)
-            
-        match = re.match(r"tesla\d", filename)
-        if match:
-            match = re.match(r"tesla(47|48|49|50|51|52)", filename)
-            if match:
-                # GPU load
-                # This nodes have only 3 GPU: gpu_load[0-2] - load, gpu_load[3-5] - memory
-                if gpuinfo:
-                    gpu_count = 3
-                    gpu_load = gpuinfo.split(",")
-                    gpu_load = list(map(int, gpu_load))
-                    gpu_mem_amount = gpu_load[3:6]
-                    gpu_load = gpu_load[:3]
-                    gpu_load = int (sum(gpu_load) / gpu_count)
-                    gpu_mem_amount = sum(gpu_mem_amount)
-                else:
-                    gpu_load = 0
-                    gpu_mem_amount = 0
-                teslas.update(cpu_load, mem_amount, gpu_load, gpu_mem_amount)
-            else:
-                # GPU load
-                # Normal nodes with 8 GPU
-                if gpuinfo:
-                    gpu_load = gpuinfo.split(",")
-                    gpu_load = list(map(int, gpu_load))
-                    gpu_count = len(gpu_load)
-                    gpu_load = int (sum(gpu_load) / gpu_count)
-                else:
-                    gpu_load = 0
-                # GPU memory
-                if gpumeminfo:
-                    gpu_mem_amount = gpumeminfo.split(",")
-                    gpu_mem_amount = list(map(int, gpu_mem_amount))
-                    gpu_mem_amount = sum(gpu_mem_amount)
-                else:
-                    gpu_mem_amount = 0
-                teslas.update(cpu_load, mem_amount, gpu_load, gpu_mem_amount)
+    except (ValueError, ZeroDivisionError):
+        # The line may be cut if it is being written right now
+        return None
+    return (partition, cpu_load, mem_amount, gpu_load, gpu_mem_amount)
+
+def aggregate_partitions(samples):
+    """Sums up samples of nodes into nodeinfo of every partition"""
+
+    # Create classes for partitions
+    partitions = {name: nodeinfo() for name in REGISTRY.partitions}
+    for partition, cpu_load, mem_amount, gpu_load, gpu_mem_amount in samples:
+        partitions[partition].update(cpu_load, mem_amount, gpu_load, gpu_mem_amount)
+
+    for name, (mem_total, gpu_mem_total) in REGISTRY.partitions.items():
+        partitions[name].set_memload(mem_total, gpu_mem_total)
+    return partitions
+
+def aggregate(samples):
+    """Sums up samples of nodes into the partitions statistics"""
+    return ','.join(partition.printinfo() for partition in aggregate_partitions(samples).values())
+
+def list_logs(log_dir, now=None):
+    """Returns names of the log files corresponding to current date"""
+    yearmonth = time.strftime("%Y%m", time.localtime(now))
+    return [os.path.basename(path) for path in glob.glob(os.path.join(log_dir, '*' + yearmonth))]
+
+def scan_file(log_dir, filename, time_now):
+    """Returns (state, sample) of the last line of the log file, state is 'ok', 'stale', 'broken' or 'unknown'"""
+    if REGISTRY.classify(filename) is None:
+        return 'unknown', None  # not a node of the known partitions
+    path = os.path.join(log_dir, filename)
+    try:
+        modify_time = os.path.getmtime(path)
+        if time_now - modify_time > STALE_TIME:
+            return 'stale', None     # the file is too old (4 minutes unmodified), throw it away
+        line = read_last_line(path)
+    except IOError:
+        return 'broken', None
+    sample = parse_sample(filename, line)
+    return ('ok' if sample else 'broken'), sample
+
+def scan_logs(log_dir=COLLECTL_DIR, threads=THREADS, now=None):
+    """Returns [(filename, state, sample)] of all logs of the current month;
+    now is the current time, it may be given to scan logs of the past"""
+
+    # fix the current time to check whether log files are outdated
+    time_now = time.time() if now is None else now
+    # Get a list of all files corresponding to current date
+    filelist = list_logs(log_dir, time_now)
+
+    if threads > 1:
+        # Overlap stat and read of the files, map() keeps the order, so the result is the same
+        with ThreadPoolExecutor(threads) as pool:
+            results = list(pool.map(scan_file, repeat(log_dir), filelist, repeat(time_now)))
+    else:
+        results = list(map(scan_file, repeat(log_dir), filelist, repeat(time_now)))
+    return [(filename, state, sample) for filename, (state, sample) in zip(filelist, results)]
+
+def get_info(log_dir=COLLECTL_DIR, threads=THREADS, now=None):
+    """Function gets node statistics"""
+    samples = [sample for filename, state, sample in scan_logs(log_dir, threads, now) if sample]
 
     # Finally finished processing all files
+    return aggregate(samples)
+
+def percentile(values, q):
+    """q-th percentile of the sorted list, with linear interpolation"""
+    if not values:
+        return 0
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+class NodeRing:
+    """Ring buffer of the last samples of one node: a time array and an array per metric"""
+
+    def __init__(self, partition, size):
+        self.partition = partition
+        self.times = array('d', bytes(8 * size))
+        self.values = [array('d', bytes(8 * size)) for metric in METRICS]
+        self.head = 0       # where the next sample goes
+        self.count = 0
+        self.modify_time = 0    # time of the log file when the latest sample was read
+
+    def append(self, timestamp, values):
+        self.times[self.head] = timestamp
+        for column, value in zip(self.values, values):
+            column[self.head] = value
+        self.head = (self.head + 1) % len(self.times)
+        self.count = min(self.count + 1, len(self.times))
+
+    def latest(self):
+        """Returns values of the latest sample"""
+        return [column[self.head - 1] for column in self.values]
+
+    def column(self, metric):
+        """Returns (times, values) of the metric in chronological order"""
+        start = (self.head - self.count) % len(self.times)
+        order = [(start + k) % len(self.times) for k in range(self.count)]
+        column = self.values[METRICS.index(metric)]
+        return [self.times[k] for k in order], [column[k] for k in order]
+
+class NodeHistory:
+    """Last samples of every node in bounded memory, with partition rollups and downsampled views"""
 
-    apollos.set_memload(mem_total_apollo, gpu_mem_total_apollo)
-    teslaHPC.set_memload(mem_total_hpc, gpu_mem_total_hpc)
-    teslas.set_memload(mem_total_tesla, gpu_mem_total_tesla)
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.nodes = {}     # filename: NodeRing
 
-    return(teslaHPC.printinfo() +','+ apollos.printinfo() +','+ teslas.printinfo())
+    def add(self, filename, timestamp, modify_time, sample):
+        partition, *values = sample
+        ring = self.nodes.get(filename)
+        if ring is None:
+            ring = self.nodes[filename] = NodeRing(partition, self.size)
+        ring.append(timestamp, values)
+        ring.modify_time = modify_time
+
+    def remove(self, filename):
+        self.nodes.pop(filename, None)
+
+    def rollup(self, partition, time_now):
+        """Statistics of the latest samples over the nodes of the partition"""
+        rings = [ring for ring in self.nodes.values() if ring.partition == partition and ring.count]
+        fresh = [ring.latest() for ring in rings if time_now - ring.modify_time <= STALE_TIME]
+        result = {'partition': partition, 'nodes': len(rings), 'stale': len(rings) - len(fresh)}
+        for k, metric in enumerate(METRICS):
+            values = sorted(sample[k] for sample in fresh)
+            result[metric] = {
+                'mean': sum(values) / len(values) if values else 0,
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'max': values[-1] if values else 0,
+            }
+        return result
+
+    def downsample(self, partition, metric, view):
+        """Averages of the metric over the nodes of the partition in buckets of the view (1m, 5m, 1h)"""
+        bucket = VIEWS[view]
+        sums = {}
+        for ring in self.nodes.values():
+            if ring.partition != partition:
+                continue
+            for timestamp, value in zip(*ring.column(metric)):
+                start = int(timestamp // bucket * bucket)
+                total, count = sums.get(start, (0, 0))
+                sums[start] = (total + value, count + 1)
+        return [(start, total / count) for start, (total, count) in sorted(sums.items())]
+
+class Inotify:
+    """Minimal binding to Linux inotify(7) through ctypes"""
+    IN_MODIFY = 0x002
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    EVENT = struct.Struct('iIII')    # wd, mask, cookie, len; followed by the name
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+
+    def add_watch(self, path, mask):
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed: ' + path)
+
+    def read(self, timeout):
+        """Waits for events up to timeout seconds, returns a list of (mask, name)"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+class LogFollower:
+    """Keeps the log files open and reads only the appended bytes, the latest sample of every node
+    is kept in memory, so a query does not touch the file system"""
+
+    def __init__(self, log_dir=COLLECTL_DIR):
+        self.log_dir = log_dir
+        self.files = {}     # filename: [handle, unfinished last line]
+        self.latest = {}    # filename: (modify time, sample)
+        self.history = NodeHistory()
+        self.lock = threading.Lock()
+        self.yearmonth = None
+
+    def rescan(self):
+        """Opens new and recreated log files and closes the ones of the previous month"""
+        self.yearmonth = time.strftime("%Y%m")
+        filelist = list_logs(self.log_dir)
+        for filename in set(self.files) - set(filelist):
+            self.files.pop(filename)[0].close()
+            with self.lock:
+                self.latest.pop(filename, None)
+                self.history.remove(filename)
+        for filename in filelist:
+            if filename in self.files:
+                try:
+                    if os.stat(os.path.join(self.log_dir, filename)).st_ino == \
+                            os.fstat(self.files[filename][0].fileno()).st_ino:
+                        continue
+                except OSError:
+                    continue
+                # The file was recreated under the same name, follow the new one
+                self.files.pop(filename)[0].close()
+            try:
+                handle = open(os.path.join(self.log_dir, filename), 'rb')
+                # Start from the tail of the file, the first line there may be cut
+                start = max(0, os.fstat(handle.fileno()).st_size - TAIL_SIZE)
+                handle.seek(start)
+                if start:
+                    handle.readline()
+            except IOError:
+                continue
+            self.files[filename] = [handle, b'']
+            self.update(filename)
+
+    def update(self, filename):
+        """Reads the bytes appended to the file since the last call"""
+        handle, rest = self.files[filename]
+        try:
+            stat = os.fstat(handle.fileno())
+            if stat.st_size < handle.tell():
+                # The file was truncated, start from the beginning
+                handle.seek(0)
+                rest = b''
+            data = handle.read()
+        except IOError:
+            return
+        if not data:
+            return
+        lines = (rest + data).split(b'\n')
+        self.files[filename][1] = lines[-1]
+        for line in lines[:-1]:
+            if line:
+                self.add_line(filename, line.decode(errors='replace'), stat.st_mtime)
+
+    def add_line(self, filename, line, modify_time):
+        sample = parse_sample(filename, line)
+        if sample:
+            # Time of the sample from the line itself if it is a timestamp, else the time of the file
+            try:
+                timestamp = float(line.split(" ", 1)[0])
+            except ValueError:
+                timestamp = modify_time
+            with self.lock:
+                self.latest[filename] = (modify_time, sample)
+                self.history.add(filename, timestamp, modify_time, sample)
+
+    def rollup(self, partition):
+        with self.lock:
+            return self.history.rollup(partition, time.time())
+
+    def downsample(self, partition, metric, view):
+        with self.lock:
+            return self.history.downsample(partition, metric, view)
+
+    def info(self):
+        """Same output as get_info(), computed from the samples in memory"""
+        time_now = time.time()
+        with self.lock:
+            samples = [sample for modify_time, sample in self.latest.values()
+                       if time_now - modify_time <= STALE_TIME]
+        return aggregate(samples)
+
+    def run(self, interval):
+        """Follows the logs forever: wakes up on inotify events, or polls every interval seconds"""
+        try:
+            watcher = Inotify()
+            watcher.add_watch(self.log_dir, Inotify.IN_MODIFY | Inotify.IN_CREATE | Inotify.IN_MOVED_TO)
+        except (OSError, AttributeError, TypeError):
+            watcher = None
+            print('inotify is not available, polling the logs', file=sys.stderr)
+        self.rescan()
+        while True:
+            if watcher:
+                events = watcher.read(interval)
+            else:
+                time.sleep(interval)
+                events = []
+            self.poll(events)
+
+    def poll(self, events):
+        """Handles the inotify events of one wait; no events means polling of all files"""
+        if events:
+            if time.strftime("%Y%m") != self.yearmonth or \
+                    any(mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO) for mask, name in events):
+                self.rescan()
+            for name in {name for mask, name in events}:
+                if name in self.files:
+                    self.update(name)
+        else:
+            # Nothing is reported (e.g. the logs are written by other hosts over NFS),
+            # look for new files and poll all of them
+            self.rescan()
+            for filename in list(self.files):
+                self.update(filename)
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # Commands: info | rollup PARTITION | trend PARTITION METRIC 1m|5m|1h
+        command = self.rfile.readline().decode().split()
+        follower = self.server.follower
+        if command == ['info']:
+            answer = follower.info()
+        elif len(command) == 2 and command[0] == 'rollup' and command[1] in REGISTRY.partitions:
+            answer = json.dumps(follower.rollup(command[1]))
+        elif len(command) == 4 and command[0] == 'trend' and command[1] in REGISTRY.partitions and \
+                command[2] in METRICS and command[3] in VIEWS:
+            answer = json.dumps(follower.downsample(*command[1:]))
+        else:
+            answer = 'unknown command'
+        self.wfile.write((answer + '\n').encode())
+
+def run_daemon(log_dir, socket_path, interval):
+    follower = LogFollower(log_dir)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, QueryHandler)
+    server.daemon_threads = True
+    server.follower = follower
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Listening on ' + socket_path, file=sys.stderr)
+    try:
+        follower.run(interval)
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+def query_daemon(socket_path, command='info'):
+    """Asks the running daemon, returns the answer without the newline"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((command + '\n').encode())
+        answer = b''
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            answer += data
+    return answer.decode().rstrip('\n')
+
+
+def node_name(filename):
+    # Log files are named like tesla12-202401
+    return re.sub(r'-?\d{6}$', '', filename)
+
+class MetricsCollector:
+    """Scans the logs in the background and keeps the latest snapshot rendered for the scrapers"""
+
+    def __init__(self, log_dir=COLLECTL_DIR, threads=THREADS, interval=15):
+        self.log_dir = log_dir
+        self.threads = threads
+        self.interval = interval
+        self.snapshot = {}
+        self.prometheus = b''
+        self.json = b'{}'
+
+    def refresh(self):
+        start = time.time()
+        results = scan_logs(self.log_dir, self.threads)
+        duration = time.time() - start
+        states = {'ok': 0, 'stale': 0, 'broken': 0, 'unknown': 0}
+        for filename, state, sample in results:
+            states[state] += 1
+        partitions = aggregate_partitions(sample for filename, state, sample in results if sample)
+        snapshot = {
+            'time': start,
+            'scan_duration': duration,
+            'files': states,
+            'partitions': {name: {column: getattr(partition, column) for column in PARTITION_METRICS}
+                           for name, partition in partitions.items()},
+            'nodes': {node_name(filename): dict(partition=sample[0], **dict(zip(METRICS, sample[1:])))
+                      for filename, state, sample in results if sample},
+        }
+        # Render once per scan, the requests only send the bytes
+        self.prometheus = render_prometheus(snapshot).encode()
+        self.json = json.dumps(snapshot).encode()
+        self.snapshot = snapshot
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as error:
+                # Keep the thread alive, otherwise the scrapers get the last snapshot forever
+                print('Scan failed: ' + repr(error), file=sys.stderr)
+            time.sleep(self.interval)
+
+def render_prometheus(snapshot):
+    """Prometheus text exposition format of the snapshot"""
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append(f'# HELP nodes_load_{name} {description}')
+        lines.append(f'# TYPE nodes_load_{name} {kind}')
+        for labels, value in samples:
+            labels = ','.join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f'nodes_load_{name}{{{labels}}} {value}' if labels else f'nodes_load_{name} {value}')
+
+    for column in PARTITION_METRICS:
+        metric('partition_' + column, 'gauge', 'Partition ' + column.replace('_', ' '),
+               [({'partition': name}, values[column]) for name, values in snapshot['partitions'].items()])
+    for column in METRICS:
+        metric('node_' + column, 'gauge', 'Node ' + column.replace('_', ' '),
+               [({'node': node, 'partition': values['partition']}, values[column])
+                for node, values in snapshot['nodes'].items()])
+    metric('files', 'gauge', 'Log files by state', [({'state': state}, count)
+                                                    for state, count in snapshot['files'].items()])
+    metric('stale_files', 'gauge', 'Log files unmodified for more than STALE_TIME', [({}, snapshot['files']['stale'])])
+    metric('scan_duration_seconds', 'gauge', 'Duration of the last scan of the logs',
+           [({}, f'{snapshot["scan_duration"]:.6f}')])
+    metric('last_scan_timestamp_seconds', 'gauge', 'Time of the last scan', [({}, f'{snapshot["time"]:.3f}')])
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        collector = self.server.collector
+        if self.path in ('/metrics', '/'):
+            self.send(collector.prometheus, 'text/plain; version=0.0.4; charset=utf-8')
+        elif self.path in ('/metrics.json', '/json'):
+            self.send(collector.json, 'application/json')
+        else:
+            self.send_error(404)
+
+    def send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass        # scrapers come every few seconds, do not flood the output
+
+def run_server(log_dir, address, port, threads, interval):
+    collector = MetricsCollector(log_dir, threads, interval)
+    collector.refresh()
+    threading.Thread(target=collector.run, daemon=True).start()
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.collector = collector
+    print(f'Serving metrics on {address or "*"}:{port}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 
 def main():
-    nodes_info = get_info()
+    parser = argparse.ArgumentParser(description='Load of the cluster partitions from collectl logs')
+    parser.add_argument('--log-dir', default=COLLECTL_DIR, help='directory with collectl logs')
+    parser.add_argument('--partitions', help='.ini file with the partitions registry (see DEFAULT_REGISTRY)')
+    parser.add_argument('--daemon', action='store_true', help='follow the logs and answer queries on the socket')
+    parser.add_argument('--query', action='store_true', help='ask the running daemon instead of scanning the logs')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='socket of the daemon')
+    parser.add_argument('--command', default='info',
+                        help='query of the daemon: info | rollup PARTITION | trend PARTITION METRIC 1m|5m|1h')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='polling interval of the daemon or refresh interval of the metrics, seconds')
+    parser.add_argument('--threads', type=int, default=THREADS, help='threads scanning the logs')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='serve Prometheus (/metrics) and JSON (/metrics.json)')
+    parser.add_argument('--bind', default='', help='address of the metrics server (default: all)')
+    args = parser.parse_args()
+
+    global REGISTRY
+    if args.partitions:
+        try:
+            with open(args.partitions, 'r') as f:
+                REGISTRY = Registry(f.read())
+        except IOError:
+            sys.exit('Cannot open the partitions registry ' + args.partitions)
+
+    if args.serve:
+        run_server(args.log_dir, args.bind, args.serve, args.threads, args.interval)
+        return
+    if args.daemon:
+        run_daemon(args.log_dir, args.socket, args.interval)
+        return
+    if args.query:
+        try:
+            print(query_daemon(args.socket, args.command))
+            return
+        except OSError:
+            if args.command != 'info':
+                print('The daemon is not running', file=sys.stderr)
+                sys.exit(1)
+            # no daemon, scan the logs ourselves
+    nodes_info = get_info(args.log_dir, args.threads)
     print(nodes_info)
 
 
@@ -0,0 +1,174 @@
+# Local SSH/SFTP server stand-in for the upload tests.
+# Accepts any password and serves a temporary directory over SFTP; remote paths are taken
+# relative to that directory. Commands run in bash in that directory, which is also the home.
+# Counts logins and the channels open at the same time, and can refuse channels over
+# a limit per connection as MaxSessions of OpenSSH does.
+
+import os
+import socket
+import threading
+import subprocess
+import paramiko
+
+
+class Handle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.writefile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class Sftp(paramiko.SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.stand_in = server.stand_in
+
+    def session_started(self):
+        self.stand_in.session_opened()
+
+    def session_ended(self):
+        self.stand_in.session_closed()
+
+    def real(self, path):
+        return os.path.join(self.stand_in.root, path.lstrip('/'))
+
+    def canonicalize(self, path):
+        return '/' + os.path.normpath(path).lstrip('/')
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.real(path)))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.real(path), flags, 0o644)
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        handle = Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, 'r+b' if flags & os.O_RDWR else
+                                                       'wb' if flags & os.O_WRONLY else 'rb')
+        return handle
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.real(path))
+        except OSError as error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+    def chattr(self, path, attr):
+        if attr.st_mtime is not None:
+            os.utime(self.real(path), (attr.st_atime, attr.st_mtime))
+        return paramiko.SFTP_OK
+
+
+def run_command(stand_in, channel, command):
+    """Runs the command in bash, streaming stdin, stdout and stderr of the channel"""
+    process = subprocess.Popen(['bash', '-c', command], cwd=stand_in.root, env=dict(os.environ, HOME=stand_in.root),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed():
+        for data in iter(lambda: channel.recv(65536), b''):
+            try:
+                process.stdin.write(data)
+            except OSError:
+                break   # the command has finished without reading all input
+        process.stdin.close()
+
+    def drain_stderr():
+        for data in iter(lambda: process.stderr.read1(65536), b''):
+            channel.sendall_stderr(data)
+
+    threading.Thread(target=feed, daemon=True).start()
+    errors = threading.Thread(target=drain_stderr, daemon=True)
+    errors.start()
+    for data in iter(lambda: process.stdout.read1(65536), b''):
+        channel.sendall(data)
+    errors.join()
+    channel.send_exit_status(process.wait())
+    channel.close()
+
+
+class Server(paramiko.ServerInterface):
+    def __init__(self, stand_in):
+        self.stand_in = stand_in
+        self.transport = None
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        with self.stand_in.lock:
+            self.stand_in.logins.append(username)
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        channels = self.stand_in.open_channels(self.transport)
+        if self.stand_in.channel_limit and channels >= self.stand_in.channel_limit:
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        with self.stand_in.lock:
+            self.stand_in.max_channels = max(self.stand_in.max_channels, channels + 1)
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_command, args=(self.stand_in, channel, command.decode()), daemon=True).start()
+        return True
+
+
+class StandIn:
+    """SSH/SFTP server on 127.0.0.1 in a background thread: with StandIn(root) as server: server.port"""
+    def __init__(self, root, channel_limit=0):
+        self.root = root
+        self.key = paramiko.RSAKey.generate(2048)
+        self.channel_limit = channel_limit      # open channels allowed per connection, 0 - any
+        self.sessions = 0
+        self.max_sessions = 0       # the most SFTP sessions open at the same time
+        self.max_channels = 0       # the most channels of one connection open at the same time
+        self.logins = []            # user names of all connections
+        self.lock = threading.Lock()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        self.transports = []
+
+    def session_opened(self):
+        with self.lock:
+            self.sessions += 1
+            self.max_sessions = max(self.max_sessions, self.sessions)
+
+    def session_closed(self):
+        with self.lock:
+            self.sessions -= 1
+
+    def open_channels(self, transport):
+        return sum(1 for channel in list(transport._channels.values()) if not channel.closed)
+
+    def serve(self):
+        while True:
+            try:
+                connection, address = self.listener.accept()
+            except OSError:
+                return      # closed by __exit__
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, Sftp)
+            server = Server(self)
+            server.transport = transport
+            transport.start_server(server=server)
+            self.transports.append(transport)
+
+    def __enter__(self):
+        self.listener.listen(5)
+        threading.Thread(target=self.serve, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
@@ -0,0 +1,57 @@
+import pytest
+
+import config_multiplier as cm
+
+
+def make_sweep(tmp_path, text):
+    ini_file = tmp_path / 'input.txt'
+    ini_file.write_text(text)
+    return cm.prepare_sweep(str(ini_file))
+
+
+def test_pack_unpack_round_trip(tmp_path):
+    space, options, template = make_sweep(tmp_path, 'a = 0...1...9\nb = x y z w v u t s r q\nc = "const"\n')
+    pack_file = str(tmp_path / 'sweep.tar')
+    expected = {I: (cur_dir, text) for I, cur_dir, text in cm.iter_rendered(space, range(space.size), options, template)}
+
+    cm.write_packed(cm.iter_rendered(space, range(space.size), options, template), pack_file)
+
+    assert len(expected) == 100
+    for I, rendered in expected.items():
+        assert cm.read_packed(pack_file, I) == rendered
+
+
+def test_pack_unpack_beyond_64_bits(tmp_path):
+    space, options, template = make_sweep(tmp_path, ''.join(f'p{k} = 0 1 2 3 4 5 6 7 8 9\n' for k in range(25)))
+    selection = cm.sample_uniform(space, 20, 0)
+    pack_file = str(tmp_path / 'sweep.tar')
+
+    cm.write_packed(cm.iter_rendered(space, selection, options, template), pack_file)
+
+    assert max(selection) >= 1 << 64
+    for I in selection:
+        assert cm.read_packed(pack_file, I)[1] == template.render(space.decode(I))
+
+
+def test_write_parallel_stops_on_write_error(tmp_path, monkeypatch):
+    space, options, template = make_sweep(tmp_path, 'a = 1 2 3\nb = 4 5\n')
+    monkeypatch.chdir(tmp_path)
+    # A directory in place of input.txt makes its write fail in a worker
+    (tmp_path / cm.dir_name(3, space.decode(3), options, space) / 'input.txt').mkdir(parents=True)
+
+    with pytest.raises(SystemExit):
+        cm.write_parallel(space, range(space.size), options, template, 2)
+
+
+def test_string_constraint_in_sectioned_ini(tmp_path):
+    space, options, template = make_sweep(tmp_path, '[Main]\nmode = fast slow\nn = 1 2\n#% mode != "slow"\n')
+
+    combinations = [space.combination(i) for I, i in space.iter_selection(range(space.size))]
+
+    assert combinations == [('fast', '1'), ('fast', '2')]
+
+
+def test_iter_indices_yields_independent_tuples():
+    space = cm.CombinationSpace({0: '1 2', 1: 'a b c'})
+
+    assert list(space.iter_indices()) == [(I, divmod(I, 3)) for I in range(6)]
@@ -0,0 +1,54 @@
+import os
+import time
+import random
+
+import nodes_load
+from bench_nodes_load import make_line
+
+
+def write_log(log_dir, name, lines):
+    path = os.path.join(log_dir, name + '-' + time.strftime("%Y%m"))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+def test_follower_polling_finds_new_files(tmp_path):
+    generator = random.Random(0)
+    write_log(str(tmp_path), 'apollo1', [make_line('apollo1', time.time(), generator)])
+    follower = nodes_load.LogFollower(str(tmp_path))
+    follower.rescan()
+
+    write_log(str(tmp_path), 'apollo2', [make_line('apollo2', time.time(), generator)])
+    follower.poll([])
+
+    assert sorted(follower.latest) == sorted(os.listdir(str(tmp_path)))
+
+
+def test_follower_reopens_recreated_file(tmp_path):
+    generator = random.Random(0)
+    old_line = make_line('apollo1', time.time(), generator)
+    path = write_log(str(tmp_path), 'apollo1', [old_line] * 3)
+    follower = nodes_load.LogFollower(str(tmp_path))
+    follower.rescan()
+
+    os.remove(path)
+    new_line = make_line('apollo1', time.time(), generator)
+    write_log(str(tmp_path), 'apollo1', [new_line])
+    follower.poll([])
+
+    filename = os.path.basename(path)
+    assert follower.latest[filename][1] == nodes_load.parse_sample(filename, new_line)
+    assert os.fstat(follower.files[filename][0].fileno()).st_ino == os.stat(path).st_ino
+
+
+def test_scan_survives_broken_bytes(tmp_path):
+    line = make_line('apollo1', time.time(), random.Random(0))
+    path = write_log(str(tmp_path), 'apollo1', [line])
+    with open(path, 'ab') as f:
+        f.write(b'\xff\xfe broken\n')
+    collector = nodes_load.MetricsCollector(str(tmp_path), threads=2)
+
+    collector.refresh()
+
+    assert collector.snapshot['files']['broken'] == 1
@@ -0,0 +1,194 @@
+import os
+import filecmp
+import socket
+import threading
+import paramiko
+import pytest
+
+import upload
+import config_multiplier as cm
+from sftp_server import StandIn
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / 'remote'
+    root.mkdir()
+    with StandIn(str(root)) as stand_in:
+        yield stand_in
+
+
+@pytest.fixture
+def ssh(server):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(hostname='127.0.0.1', port=server.port, username='user', password='password',
+                   allow_agent=False, look_for_keys=False)
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """Local directory of a few hundred small files in nested directories, as a sweep looks"""
+    local = tmp_path / 'local' / 'job'
+    for k in range(200):
+        conf = local / f'conf{k}_dt={k / 10}' / ('sub' if k % 7 == 0 else '')
+        conf.mkdir(parents=True, exist_ok=True)
+        (conf / 'input.txt').write_text(f'dt = {k / 10}\nsteps = {k}\n' * (k % 5 + 1))
+    (local / 'empty').mkdir()
+    (local / 'runme.sh').write_bytes(os.urandom(100000))
+    return str(local)
+
+
+def make_dirs(server, directories):
+    # The stand-in serves no shell for make_remote_dirs, the directories are made on its disk
+    for directory in directories:
+        os.makedirs(os.path.join(server.root, directory), exist_ok=True)
+
+
+def assert_same_tree(left, right):
+    comparison = filecmp.dircmp(left, right)
+    assert not comparison.left_only and not comparison.right_only and not comparison.funny_files
+    assert filecmp.cmpfiles(left, right, comparison.common_files, shallow=False)[0] == comparison.common_files
+    for directory in comparison.common_dirs:
+        assert_same_tree(os.path.join(left, directory), os.path.join(right, directory))
+
+
+def test_walk_tree_places_the_directory_into_remote_path(tree):
+    directories, files = upload.walk_tree(tree, 'data')
+    assert directories[0] == 'data/job'
+    assert 'data/job/empty' in directories
+    assert (os.path.join(tree, 'runme.sh'), 'data/job/runme.sh') in files
+    assert len(files) == 201
+
+
+def test_upload_files_over_several_channels(server, ssh, tree):
+    directories, files = upload.walk_tree(tree, 'data')
+    make_dirs(server, directories)
+
+    count, size, seconds = upload.upload_files(ssh.open_sftp, files, 4)
+
+    assert count == len(files)
+    assert size == sum(os.path.getsize(local) for local, remote in files)
+    assert server.max_sessions > 1
+    assert_same_tree(tree, os.path.join(server.root, 'data', 'job'))
+
+
+def test_upload_files_keeps_mtimes(server, ssh, tree):
+    directories, files = upload.walk_tree(tree, 'data')
+    make_dirs(server, directories)
+    os.utime(files[0][0], (1000000000, 1000000000))
+
+    upload.upload_files(ssh.open_sftp, files, 4, preserve_times=True)
+
+    assert upload.local_stat(files[0][0]) == upload.local_stat(os.path.join(server.root, files[0][1]))
+
+
+def test_upload_files_holds_sessions(server, ssh, tree):
+    directories, files = upload.walk_tree(tree, 'data')
+    make_dirs(server, directories)
+
+    upload.upload_files(ssh.open_sftp, files, 8, sessions=threading.BoundedSemaphore(2))
+
+    assert server.max_sessions <= 2
+    assert_same_tree(tree, os.path.join(server.root, 'data', 'job'))
+
+
+def test_upload_files_raises_on_missing_directory(server, ssh, tree):
+    directories, files = upload.walk_tree(tree, 'data')
+
+    with pytest.raises(IOError):
+        upload.upload_files(ssh.open_sftp, files, 4)
+
+
+def make_job(tmp_path, name, port, user='user', **fields):
+    """A job directory whose runme.sh 'submits' two jobs, and the batch entry for it"""
+    local = tmp_path / 'jobs' / name
+    (local / 'conf0').mkdir(parents=True)
+    (local / 'conf0' / 'input.txt').write_text('dt = 0.1\n')
+    (local / 'config_multiplier.php').write_text('#!/bin/bash\necho multiplied $1\n')
+    (local / 'runme.sh').write_text(f'#!/bin/bash\necho "Submitted batch job {port}1"\n'
+                                    f'echo "Submitted batch job {port}2"\n')
+    binary = tmp_path / 'bin' / 'solver'
+    binary.parent.mkdir(exist_ok=True)
+    binary.write_text('')
+    return dict(user=user, password='password', local_path=str(local), remote_path='runs/' + user,
+                binary_path=str(binary), alternatename='', cluster='imm', host='127.0.0.1', port=port, **fields)
+
+
+def test_run_batch_reuses_one_connection_per_user(server, tmp_path):
+    jobs = [make_job(tmp_path, f'job{k}', server.port, user='alice' if k % 2 else 'bob') for k in range(6)]
+
+    results = upload.run_batch(jobs, workers=4)
+
+    assert [result['ok'] for result in results] == [True] * 6
+    assert [result['jobs_ids'] for result in results] == [[f'{server.port}1', f'{server.port}2']] * 6
+    assert sorted(server.logins) == ['alice', 'bob']
+    for job in jobs:
+        uploaded = os.path.join(server.root, job['remote_path'], os.path.basename(job['local_path']))
+        # The steps add binary, source and logfile next to the uploaded files
+        assert_same_tree(os.path.join(job['local_path'], 'conf0'), os.path.join(uploaded, 'conf0'))
+        assert filecmp.cmp(os.path.join(job['local_path'], 'runme.sh'), os.path.join(uploaded, 'runme.sh'), shallow=False)
+
+
+def test_run_batch_keeps_channels_under_max_sessions(tmp_path):
+    root = tmp_path / 'remote'
+    root.mkdir()
+    with StandIn(str(root), channel_limit=10) as server:
+        jobs = [make_job(tmp_path, f'job{k}', server.port, transport='sftp') for k in range(8)]
+
+        results = upload.run_batch(jobs, workers=8)
+
+        assert [result['error'] for result in results] == [''] * 8
+        assert server.logins == ['user']
+        assert server.max_channels <= upload.MAX_SESSIONS
+
+
+def test_failed_job_does_not_stop_the_batch(server, tmp_path):
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    port = closed.getsockname()[1]
+    closed.close()
+    jobs = [make_job(tmp_path, 'good1', server.port), make_job(tmp_path, 'bad', port),
+            make_job(tmp_path, 'good2', server.port)]
+
+    results = upload.run_batch(jobs, workers=3)
+
+    assert [result['ok'] for result in results] == [True, False, True]
+    assert results[1]['error'] and not results[1]['jobs_ids']
+
+
+def test_stream_tar_with_chatty_remote_tar(server, ssh, tree, monkeypatch):
+    # More stderr than the channel window holds, as per-member warnings of tar may give
+    monkeypatch.setitem(upload.UNTAR, '', 'yes "tar: time stamp in the future" | head -c 4000000 >&2; tar -x -C ')
+    directories, files = upload.walk_tree(tree, 'data')
+    make_dirs(server, directories)
+
+    count, size, seconds = upload.stream_tar(ssh, files, tree, 'data')
+
+    assert count == len(files)
+    assert_same_tree(tree, os.path.join(server.root, 'data', 'job'))
+
+
+@pytest.mark.parametrize('transport', ['tar', 'sftp'])
+def test_pipeline_renders_the_sweep_into_the_upload(server, ssh, tmp_path, transport, monkeypatch):
+    monkeypatch.setattr(upload, 'SWEEP_BATCH', 4)     # several batches of directories on the SFTP path
+    local = tmp_path / 'local' / 'sweep'
+    local.mkdir(parents=True)
+    (local / 'input.txt').write_text('a = 1 2 3\nb = 0...0.5...1\nc = "x"\n')
+    client = upload.SetSettings(['user', 'password', str(local), 'runs', '/bin/true', '', 'imm', 'full', 'pipeline'])
+    client.CLIENT = ssh
+    client.TRANSPORT = transport
+
+    upload.upload_directory(client)
+
+    space, options, template = cm.prepare_sweep(str(local / 'input.txt'))
+    uploaded = os.path.join(server.root, 'runs', 'sweep')
+    rendered = list(cm.iter_rendered(space, range(space.size), options, template))
+    assert sorted(os.listdir(uploaded)) == sorted(['input.txt'] + [cur_dir for I, cur_dir, text in rendered])
+    for I, cur_dir, text in rendered:
+        with open(os.path.join(uploaded, cur_dir, 'input.txt')) as f:
+            assert f.read() == text
+    # Nothing is written to the local directory
+    assert os.listdir(str(local)) == ['input.txt']
@@ -1,29 +1,69 @@
 #!/usr/bin/env python3
 # Receives user, password, local temp directory, remote path in home, path to the binary,
-# template for dir names, computational cluster name;
+# template for dir names, computational cluster name and, optionally, the sync mode:
+# full (default) - upload everything, mtime - only files with other size or mtime on the server,
+# hash - only files with other size or sha1 on the server, manifest - only files changed since
+# the last upload according to the local manifest (no requests to the server);
+# and 'pipeline' after it to generate the conf*/input.txt sweep from input.txt of the directory on the fly,
+# straight into the upload stream, instead of running config_multiplier.php on the server;
 # then open connection to the remote server and upload data.
+# With --batch jobs.json uploads and submits a list of such jobs concurrently (see load_jobs).
 # Kuklin E.Y. 2022
 
 import sys
 import os
+import io
+import json
+import re
+import shlex
+import tarfile
+import hashlib
+import itertools
+import queue
+import threading
+import argparse
+import concurrent.futures
 import paramiko
 import time
+from collections import namedtuple
 from loguru import logger
+import config_multiplier as cm
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MKDIR_BATCH = 65536     # max length of directory names in one mkdir command
+HASH_BATCH = 500        # files in one sha1sum command
+SWEEP_BATCH = 10000     # generated configs per mkdir command in the pipeline mode over SFTP
+MAX_SESSIONS = 8        # channels open at once on one connection, below MaxSessions 10 of OpenSSH
+SYNC_MODES = ('full', 'mtime', 'hash', 'manifest')
+# Remote commands unpacking the tar stream for each compression
+UNTAR = {'': 'tar -x -C ', 'gz': 'tar -xz -C ', 'zstd': 'zstd -dcq | tar -x -C '}
+# Outcome of a remote command run by run_step
+StepResult = namedtuple('StepResult', 'command exit_status stdout stderr seconds')
 
 
 class SetSettings:
-    def __init__(self):
+    def __init__(self, args=None):
+        # The same arguments as on the command line, without the script name
+        args = sys.argv[1:] if args is None else args
         self.IMM_URL = 'some/url/1'
         self.URFU_URL = 'some/url/2'
         self.PORT_IMM = 22
         self.PORT_URFU = 22
-        self.USER = sys.argv[1]
-        self.PASSWD = sys.argv[2]
-        self.LOCAL_PATH = sys.argv[3]
-        self.REMOTE_PATH = sys.argv[4]
-        self.BINARY_PATH = sys.argv[5]
-        self.ALTERNATENAME = sys.argv[6]
-        self.CLUSTER = sys.argv[7]
+        self.USER = args[0]
+        self.PASSWD = args[1]
+        self.LOCAL_PATH = args[2]
+        self.REMOTE_PATH = args[3]
+        self.BINARY_PATH = args[4]
+        self.ALTERNATENAME = args[5]
+        self.CLUSTER = args[6]
+        self.SYNC = args[7] if len(args) > 7 else 'full'
+        self.PIPELINE = len(args) > 8 and args[8] == 'pipeline'
+        if self.SYNC not in SYNC_MODES:
+            logger.error('Unknown sync mode: ' + self.SYNC)
+            sys.exit()
 
         if self.CLUSTER == 'urfu':
             self.HOST = self.URFU_URL
@@ -32,8 +72,15 @@ class SetSettings:
             self.HOST = self.IMM_URL
             self.PORT = self.PORT_IMM
 
-        self.HEAD, self.TAIL = os.path.split(self.LOCAL_PATH)
+        self.HEAD, self.TAIL = os.path.split(self.LOCAL_PATH.rstrip('/\\'))
         self.CLIENT = None
+        self.STEPS = []             # StepResult of every remote command, in order
+        self.UPLOAD_CHANNELS = 8    # parallel SFTP channels over the connection
+        # Open channels of the connection, shared by all jobs using it in the batch mode
+        self.SESSIONS = threading.BoundedSemaphore(MAX_SESSIONS)
+        self.TRANSPORT = 'tar'      # tar - one tar stream into remote tar -x, sftp - put file by file
+        self.COMPRESSION = 'gz'     # compression of the tar stream: '', gz or zstd
+        self.SWEEP_INI = 'input.txt'    # .ini file of the sweep in the local directory for the pipeline mode
 
     def open_connection(self):
         self.CLIENT = paramiko.SSHClient()
@@ -51,48 +98,401 @@ class SetSettings:
         sys.exit()
 
 
-def put_all(self, local_path, remote_path):
-    """Recursively uploads a directory"""
-    os.chdir(os.path.split(local_path)[0])
-    parent = os.path.split(local_path)[1]
-    for walker in os.walk(parent):
+def walk_tree(local_path, remote_path):
+    """Returns remote directories and (local, remote) file pairs of the tree,
+    the local directory itself is placed into remote_path"""
+    head = os.path.split(local_path)[0]
+    directories = []
+    files = []
+    for walker in os.walk(local_path):
         # .replace('\\', '/') makes unix-type path in case of Win user
-        self.mkdir(os.path.join(remote_path, walker[0]).replace('\\', '/'))
+        remote_dir = os.path.join(remote_path, os.path.relpath(walker[0], head)).replace('\\', '/')
+        directories.append(remote_dir)
         for file in walker[2]:
-            self.put(os.path.join(walker[0], file), os.path.join(remote_path, walker[0], file).replace('\\', '/'))
+            files.append((os.path.join(walker[0], file), remote_dir + '/' + file))
+    return directories, files
+
+
+def make_remote_dirs(ssh, directories):
+    """Creates the directories with a few 'mkdir -p' commands instead of a round trip per directory"""
+    batch = []
+    length = 0
+    for directory in directories + [None]:
+        if batch and (directory is None or length + len(directory) > MKDIR_BATCH):
+            stdin, stdout, stderr = ssh.exec_command('mkdir -p ' + ' '.join(map(shlex.quote, batch)))
+            if stdout.channel.recv_exit_status() != 0:
+                raise paramiko.SSHException('mkdir failed: ' + stderr.read().decode(errors='replace'))
+            batch = []
+            length = 0
+        if directory is not None:
+            batch.append(directory)
+            length += len(directory) + 1
+
+
+def upload_files(open_sftp, files, channels, preserve_times=False, sessions=None):
+    """Uploads (local, remote) file pairs over a pool of SFTP channels, returns (files, bytes, seconds);
+    open_sftp opens a new SFTP session, e.g. SSHClient.open_sftp; every channel holds a slot
+    of the sessions semaphore, if given, while it is open"""
+    tasks = queue.Queue()
+    for item in files:
+        tasks.put(item)
+    errors = []
+    sent = [0, 0]       # files, bytes
+    lock = threading.Lock()
+
+    def worker():
+        sftp = None
+        if sessions:
+            sessions.acquire()
+        try:
+            sftp = open_sftp()
+            while not errors:
+                try:
+                    local_file, remote_file = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                # confirm=False saves a stat round trip per file
+                sftp.put(local_file, remote_file, confirm=False)
+                if preserve_times:
+                    # The same mtime on both sides lets the next sync skip the file
+                    stat = os.stat(local_file)
+                    sftp.utime(remote_file, (stat.st_atime, stat.st_mtime))
+                with lock:
+                    sent[0] += 1
+                    sent[1] += os.path.getsize(local_file)
+        except (paramiko.SSHException, IOError) as error:
+            errors.append(error)
+        finally:
+            if sftp:
+                sftp.close()
+            if sessions:
+                sessions.release()
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(channels, len(files))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return sent[0], sent[1], time.time() - start
+
+
+class ChannelWriter:
+    """Minimal file object sending everything written to the channel"""
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        self.channel.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def stream_tar(ssh, files, local_path, remote_path, compression='', generated=()):
+    """Streams the (local, remote) files and the generated (remote, text) files as a tar into tar -x
+    on the server, returns (files, bytes, seconds); nothing is staged on the local disk"""
+    if compression == 'zstd' and zstandard is None:
+        logger.warning('zstandard is not installed, the tar stream is compressed with gzip')
+        compression = 'gz'
+    head = os.path.split(local_path)[0]
+    start = time.time()
+    stdin, stdout, stderr = ssh.exec_command(UNTAR[compression] + shlex.quote(remote_path))
+    channel = stdin.channel
+    # stderr is drained while sending, warnings of tar must not fill the channel window and stall the stream
+    errors = []
+    reader = threading.Thread(target=lambda: errors.append(stderr.read()), daemon=True)
+    reader.start()
+    writer = ChannelWriter(channel)
+    compressor = None
+    if compression == 'zstd':
+        compressor = zstandard.ZstdCompressor().stream_writer(writer, closefd=False)
+    count = size = 0
+    with tarfile.open(fileobj=compressor or writer, mode='w|gz' if compression == 'gz' else 'w|',
+                      format=tarfile.GNU_FORMAT) as tar:
+        for local_file, remote_file in files:
+            # .replace('\\', '/') makes unix-type path in case of Win user
+            tar.add(local_file, arcname=os.path.relpath(local_file, head).replace('\\', '/'), recursive=False)
+            count += 1
+            size += os.path.getsize(local_file)
+        mtime = time.time()
+        for remote_file, text in generated:
+            data = text.encode()
+            info = tarfile.TarInfo(remote_file[len(remote_path) + 1:])
+            info.size = len(data)
+            info.mtime = mtime
+            tar.addfile(info, io.BytesIO(data))
+            count += 1
+            size += len(data)
+    if compressor:
+        compressor.close()
+    channel.shutdown_write()
+    exit_status = channel.recv_exit_status()
+    reader.join()
+    if exit_status != 0:
+        raise paramiko.SSHException('tar failed: ' + errors[0].decode(errors='replace'))
+    return count, size, time.time() - start
+
+
+def upload_generated(open_sftp, generated, channels, sessions=None):
+    """Writes the generated (remote, text) files over a pool of SFTP channels into existing directories;
+    returns (files, bytes, seconds); sessions is used as in upload_files"""
+    errors = []
+    sent = [0, 0]       # files, bytes
+    lock = threading.Lock()
+    generated = iter(generated)
+
+    def worker():
+        sftp = None
+        if sessions:
+            sessions.acquire()
+        try:
+            sftp = open_sftp()
+            while not errors:
+                # The channels take files from the generator in turn, nothing is rendered ahead
+                with lock:
+                    item = next(generated, None)
+                if item is None:
+                    break
+                remote_file, text = item
+                data = text.encode()
+                sftp.putfo(io.BytesIO(data), remote_file, confirm=False)
+                with lock:
+                    sent[0] += 1
+                    sent[1] += len(data)
+        except (paramiko.SSHException, IOError) as error:
+            errors.append(error)
+        finally:
+            if sftp:
+                sftp.close()
+            if sessions:
+                sessions.release()
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(max(1, channels))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return sent[0], sent[1], time.time() - start
+
+
+def upload_sweep(client):
+    """Renders the sweep straight into SFTP writes, returns (files, bytes, seconds); the directories
+    of every batch of configs are created with a few mkdir commands first"""
+    count = size = 0
+    start = time.time()
+    generated = render_sweep(client)
+    while True:
+        batch = list(itertools.islice(generated, SWEEP_BATCH))
+        if not batch:
+            return count, size, time.time() - start
+        with client.SESSIONS:
+            make_remote_dirs(client.CLIENT, sorted({os.path.dirname(remote_file) for remote_file, text in batch}))
+        sent = upload_generated(client.CLIENT.open_sftp, batch, client.UPLOAD_CHANNELS, client.SESSIONS)
+        count += sent[0]
+        size += sent[1]
+
+
+def render_sweep(client):
+    """Yields (remote file, text) of every config of the sweep, named as config_multiplier.py writes them"""
+    space, options, template = cm.prepare_sweep(os.path.join(client.LOCAL_PATH, client.SWEEP_INI))
+    remote_dir = client.REMOTE_PATH + '/' + client.TAIL
+    for I, cur_dir, text in cm.iter_rendered(space, range(space.size), options, template):
+        yield remote_dir + '/' + cur_dir + '/input.txt', text
+
+
+def remote_stats(ssh, remote_dir):
+    """Returns {remote file: (size, mtime)} of all files under the directory, with one find command"""
+    stdin, stdout, stderr = ssh.exec_command('find ' + shlex.quote(remote_dir) + " -type f -printf '%p\\t%s\\t%T@\\n'")
+    stats = {}
+    for line in stdout.read().decode(errors='replace').splitlines():
+        path, size, mtime = line.rsplit('\t', 2)
+        stats[path] = (int(size), int(float(mtime)))
+    stdout.channel.recv_exit_status()       # the directory may not exist yet, that is fine
+    return stats
+
+
+def remote_hashes(ssh, remote_files):
+    """Returns {remote file: sha1} with a few sha1sum commands"""
+    hashes = {}
+    for start in range(0, len(remote_files), HASH_BATCH):
+        batch = remote_files[start:start + HASH_BATCH]
+        stdin, stdout, stderr = ssh.exec_command('sha1sum -- ' + ' '.join(map(shlex.quote, batch)))
+        for line in stdout.read().decode(errors='replace').splitlines():
+            digest, path = line.split('  ', 1)
+            hashes[path] = digest
+        stdout.channel.recv_exit_status()
+    return hashes
+
+
+def local_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def local_stat(path):
+    stat = os.stat(path)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def upload_manifest_path(client):
+    """Sizes and mtimes of the files of the last upload are kept next to the local directory,
+    separately for every user, server and remote path"""
+    target = f'{client.USER}@{client.HOST}:{client.PORT}'
+    remote = hashlib.sha1(client.REMOTE_PATH.encode()).hexdigest()[:8]
+    name = '.' + client.TAIL + '.' + re.sub(r'[^\w.@-]', '_', target) + '.' + remote + '.upload.json'
+    return os.path.join(client.HEAD, name)
+
+
+def load_upload_manifest(manifest_file):
+    try:
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def select_changed(client, files):
+    """Leaves only new and changed files according to the sync mode of the client"""
+    if client.SYNC == 'manifest':
+        manifest = load_upload_manifest(upload_manifest_path(client))
+        return [(local, remote) for local, remote in files if manifest.get(remote) != list(local_stat(local))]
+    remote = remote_stats(client.CLIENT, client.REMOTE_PATH + '/' + client.TAIL)
+    if client.SYNC == 'mtime':
+        return [(local, remote_file) for local, remote_file in files if remote.get(remote_file) != local_stat(local)]
+    # hash: files of the same size are compared by sha1 computed on the server
+    changed = []
+    same_size = []
+    for local, remote_file in files:
+        if remote_file in remote and remote[remote_file][0] == os.path.getsize(local):
+            same_size.append((local, remote_file))
+        else:
+            changed.append((local, remote_file))
+    hashes = remote_hashes(client.CLIENT, [remote_file for local, remote_file in same_size])
+    changed += [(local, remote_file) for local, remote_file in same_size
+                if hashes.get(remote_file) != local_hash(local)]
+    return changed
+
+
+def save_upload_manifest(client, files):
+    manifest_file = upload_manifest_path(client)
+    try:
+        # Written aside and renamed, so a reader never sees a half-written manifest
+        with open(manifest_file + '.tmp', 'w') as f:
+            json.dump({remote: local_stat(local) for local, remote in files}, f)
+        os.replace(manifest_file + '.tmp', manifest_file)
+    except IOError:
+        logger.warning('Cannot save the upload manifest ' + manifest_file)
 
 
 def upload_directory(client):
+    if client.PIPELINE and not os.path.exists(os.path.join(client.LOCAL_PATH, client.SWEEP_INI)):
+        logger.error('No ' + client.SWEEP_INI + ' for the pipeline mode in ' + client.LOCAL_PATH)
+        client.close_connection()
+    if client.PIPELINE and client.ALTERNATENAME:
+        logger.warning('The dir name template ' + client.ALTERNATENAME + ' is not used in the pipeline mode, '
+                       'configs are named as config_multiplier.py does')
     try:
-        client.CLIENT.exec_command('mkdir -p ' + client.REMOTE_PATH)
-        time.sleep(1)
-        sftp = client.CLIENT.open_sftp()
-        put_all(sftp, client.LOCAL_PATH, client.REMOTE_PATH)
-        sftp.close()
+        directories, files = walk_tree(client.LOCAL_PATH, client.REMOTE_PATH)
+        all_files = files
+        if client.SYNC != 'full':
+            with client.SESSIONS:
+                files = select_changed(client, files)
+            logger.info(f'Sync ({client.SYNC}): {len(files)} of {len(all_files)} files are new or changed')
+        with client.SESSIONS:
+            make_remote_dirs(client.CLIENT, [client.REMOTE_PATH] + directories)
+        count = None
+        if client.TRANSPORT == 'tar':
+            try:
+                with client.SESSIONS:
+                    count, size, seconds = stream_tar(client.CLIENT, files, client.LOCAL_PATH, client.REMOTE_PATH,
+                                                      client.COMPRESSION,
+                                                      render_sweep(client) if client.PIPELINE else ())
+            except (paramiko.SSHException, OSError) as error:
+                # e.g. no tar or zstd on the server
+                logger.warning(f'Tar upload failed, falling back to SFTP: {error}')
+        if count is None:
+            count, size, seconds = upload_files(client.CLIENT.open_sftp, files, client.UPLOAD_CHANNELS,
+                                                preserve_times=client.SYNC != 'full', sessions=client.SESSIONS)
+            if client.PIPELINE:
+                # The sweep is rendered again from the start, a failed tar stream may have taken a part of it
+                generated = upload_sweep(client)
+                count, size, seconds = count + generated[0], size + generated[1], seconds + generated[2]
+        if client.SYNC != 'full':
+            save_upload_manifest(client, all_files)
+        seconds = max(seconds, 1e-6)
+        logger.info(f'Uploaded {count} files, {size} bytes in {seconds:.1f} s: '
+                    f'{count / seconds:.0f} files/s, {size / seconds / 1e6:.2f} MB/s')
         logger.success('Uploading data done.')
-    except paramiko.SSHException:
+    except (paramiko.SSHException, IOError):
         logger.error('Cannot upload the target directory. Some error occurred...')
         client.close_connection()
 
 
+def logged(command, append=True):
+    """Wraps the command to copy its stdout and stderr to the logfile in the working directory;
+    the exit status is the one of the command"""
+    # Both tees append, so they do not overwrite each other
+    return (('' if append else ': > logfile; ') +
+            'set -o pipefail; (' + command + ') 2> >(tee -a logfile >&2) | tee -a logfile')
+
+
+def run_step(client, command, check=False):
+    """Runs the command in the remote working directory and blocks until it exits, without polling;
+    returns StepResult and keeps it in client.STEPS, raises SSHException on non-zero exit if check"""
+    start = time.time()
+    with client.SESSIONS:
+        stdin, stdout, stderr = client.CLIENT.exec_command(
+            # the braces keep the whole command behind the cd, not only its first part
+            'cd ' + shlex.quote(client.REMOTE_PATH + '/' + client.TAIL) + ' && { ' + command + '\n}')
+        stdin.close()
+        # stderr is drained in parallel, so a chatty command never stalls on a full channel window
+        errors = []
+        reader = threading.Thread(target=lambda: errors.append(stderr.read()))
+        reader.start()
+        output = stdout.read()
+        reader.join()
+        exit_status = stdout.channel.recv_exit_status()
+    result = StepResult(command, exit_status, output.decode(errors='replace'),
+                        errors[0].decode(errors='replace'), time.time() - start)
+    client.STEPS.append(result)
+    if check and result.exit_status != 0:
+        raise paramiko.SSHException(f'exit status {result.exit_status}: {result.stderr.strip()}')
+    return result
+
+
+def report_step(name, result):
+    if result.exit_status == 0:
+        logger.success(f'{name} done in {result.seconds:.1f} s.')
+    else:
+        logger.warning(f'{name} finished with exit status {result.exit_status}: {result.stderr.strip()[-500:]}')
+
+
 def create_link(client):
     try:
-        client.CLIENT.exec_command('ln -s ' + client.BINARY_PATH + ' ' +
-                                   client.REMOTE_PATH + '/' + client.TAIL + '/binary')
-        logger.success('Link created.')
-        time.sleep(1)
-    except paramiko.SSHException:
-        logger.error('Link creation failed.')
+        # -f -n replace the link left by a previous upload of the directory
+        result = run_step(client, 'ln -sfn ' + shlex.quote(client.BINARY_PATH) + ' binary', check=True)
+        report_step('Link creation', result)
+    except paramiko.SSHException as error:
+        logger.error(f'Link creation failed: {error}')
         client.close_connection()
 
 
 def copy_source(client):
     try:
-        client.CLIENT.exec_command('cd ' + client.REMOTE_PATH + '/' + client.TAIL +
-                                   '; binpath=$(dirname `readlink binary`); (echo $binpath; mkdir source; ' +
-                                   'cp -v $binpath/{*.c,*.h,*akefile} source; ' +
-                                   'cp -v $(readlink binary) source) &> logfile;')
-        logger.success('Source code copied.')
+        result = run_step(client, logged('binpath=$(dirname `readlink binary`); echo $binpath; mkdir -p source; '
+                                         'cp -v $binpath/{*.c,*.h,*akefile} source; '
+                                         'cp -v $(readlink binary) source', append=False))
+        report_step('Copying of the source code', result)
     except paramiko.SSHException:
         logger.error('Copying of the source code failed.')
         client.close_connection()
@@ -100,14 +500,9 @@ def copy_source(client):
 
 def config_multiplier(client):
     try:
-        channel = client.CLIENT.get_transport().open_session()
-        channel.exec_command('cd ' + client.REMOTE_PATH + '/' + client.TAIL +
-                             '; (chmod 755 config_multiplier.php; ./config_multiplier.php ' +
-                             client.ALTERNATENAME + ') &>> logfile;')
-        # Wait for it to finish
-        while not channel.exit_status_ready():
-            time.sleep(1)
-        logger.success('config_multiplier done.')
+        result = run_step(client, logged('chmod 755 config_multiplier.php; ./config_multiplier.php ' +
+                                         client.ALTERNATENAME))
+        report_step('config_multiplier', result)
     except paramiko.SSHException:
         logger.error('config_multiplier failed.')
         client.close_connection()
@@ -115,39 +510,157 @@ def config_multiplier(client):
 
 def launch_runme(client):
     try:
-        # Execute some remote commands
-        channel = client.CLIENT.get_transport().open_session()
-        channel.exec_command('cd ' + client.REMOTE_PATH + '/' + client.TAIL +
-                             '; (. ~/.bashrc; . ~/.bash_profile; chmod 755 runme.sh; ./runme.sh) &>> logfile;')
-        # Wait for it to finish
-        while not channel.exit_status_ready():
-            time.sleep(1)
-        logger.success('runme done.')
+        result = run_step(client, logged('. ~/.bashrc; . ~/.bash_profile; chmod 755 runme.sh; ./runme.sh'))
+        report_step('runme', result)
     except paramiko.SSHException:
         logger.error('runme failed.')
         client.close_connection()
 
 
 def get_jobs_ids(client):
+    """Prints IDs of the submitted jobs as a comma-terminated list and returns them"""
     try:
-        stdin, stdout, stderr = client.CLIENT.exec_command(
-            'cd ' + client.REMOTE_PATH + '/' + client.TAIL +
-            '; cat logfile | grep "Submitted batch job" | awk \'{ print $NF }\' ORS=","', get_pty=1)
-        jobs_ids = stdout.read()
-        # Get rid of the b-prefix and '
-        print(jobs_ids.decode('utf-8'))
+        result = run_step(client, 'grep "Submitted batch job" logfile | awk \'{ print $NF }\'')
+        jobs_ids = result.stdout.split()
+        print(''.join(job_id + ',' for job_id in jobs_ids))
+        return jobs_ids
     except paramiko.SSHException:
         logger.error("Error in job ID retrieving")
         client.close_connection()
 
 
+class JobFailed(Exception):
+    pass
+
+
+class BatchClient(SetSettings):
+    """Settings of one job of a batch; a failed step ends the job instead of the process
+    and leaves the shared connection open"""
+    def close_connection(self):
+        raise JobFailed()
+
+
+class ConnectionPool:
+    """One SSH connection per (host, port, user), shared by all jobs of the batch,
+    with one semaphore per connection limiting its open channels"""
+    def __init__(self):
+        self.clients = {}
+        self.sessions = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, settings):
+        """Returns the connection and its sessions semaphore"""
+        key = (settings.HOST, settings.PORT, settings.USER)
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+        # Jobs of the same user wait for one handshake instead of making their own
+        with key_lock:
+            if key not in self.clients:
+                client = paramiko.SSHClient()
+                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                client.connect(hostname=settings.HOST, username=settings.USER,
+                               password=settings.PASSWD, port=settings.PORT)
+                logger.success('Connection opened: ' + settings.USER + ', ' + settings.CLUSTER)
+                self.clients[key] = client
+                self.sessions[key] = threading.BoundedSemaphore(MAX_SESSIONS)
+            return self.clients[key], self.sessions[key]
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients.clear()
+
+
+JOB_FIELDS = ('user', 'password', 'local_path', 'remote_path', 'binary_path', 'alternatename', 'cluster')
+
+
+def load_jobs(jobs_file):
+    """Reads a JSON list of jobs: objects with JOB_FIELDS and optional sync, pipeline, transport, host and port"""
+    with open(jobs_file, 'r') as f:
+        jobs = json.load(f)
+    for number, job in enumerate(jobs):
+        missing = [field for field in JOB_FIELDS if field not in job]
+        if missing:
+            raise ValueError(f'job {number}: no ' + ', '.join(missing))
+        if job.get('sync', 'full') not in SYNC_MODES:
+            raise ValueError(f'job {number}: unknown sync mode ' + job['sync'])
+    return jobs
+
+
+def run_job(pool, job):
+    """Uploads and submits one job over the pooled connection, returns a dict for the batch result"""
+    client = BatchClient([job[field] for field in JOB_FIELDS] + [job.get('sync', 'full'),
+                                                                 'pipeline' if job.get('pipeline') else ''])
+    # host and port override the cluster defaults, e.g. for a local test server
+    client.HOST = job.get('host', client.HOST)
+    client.PORT = job.get('port', client.PORT)
+    client.TRANSPORT = job.get('transport', client.TRANSPORT)
+    result = {'user': client.USER, 'cluster': client.CLUSTER, 'host': client.HOST,
+              'local_path': client.LOCAL_PATH, 'ok': False, 'jobs_ids': [], 'error': ''}
+    start = time.time()
+    try:
+        client.CLIENT, client.SESSIONS = pool.get(client)
+        upload_directory(client)
+        create_link(client)
+        copy_source(client)
+        if not client.PIPELINE:
+            config_multiplier(client)
+        launch_runme(client)
+        result['jobs_ids'] = get_jobs_ids(client)
+        result['ok'] = True
+    except JobFailed:
+        result['error'] = 'step failed, see the log'
+    except SystemExit:
+        # config_multiplier exits on a broken .ini file
+        result['error'] = 'cannot render the sweep, see the log'
+    except (paramiko.SSHException, OSError) as error:
+        result['error'] = f'{type(error).__name__}: {error}'
+    result['seconds'] = time.time() - start
+    result['steps'] = [{'command': step.command, 'exit_status': step.exit_status, 'seconds': step.seconds}
+                       for step in client.STEPS]
+    return result
+
+
+def run_batch(jobs, workers=8):
+    """Runs the jobs concurrently on a bounded pool of threads, returns their results in the order of jobs"""
+    pool = ConnectionPool()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            return list(executor.map(lambda job: run_job(pool, job), jobs))
+    finally:
+        pool.close()
+
+
+def batch_main(args):
+    parser = argparse.ArgumentParser(prog='upload.py --batch', description='Upload and submit a list of jobs')
+    parser.add_argument('jobs_file', help='JSON list of jobs')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='jobs running at the same time')
+    parser.add_argument('-o', '--output', default='upload_batch.json', help='JSON file for results')
+    args = parser.parse_args(args)
+    try:
+        jobs = load_jobs(args.jobs_file)
+    except (IOError, ValueError) as error:
+        logger.error(f'Cannot read jobs: {error}')
+        sys.exit(1)
+    results = run_batch(jobs, args.workers)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    failed = sum(1 for result in results if not result['ok'])
+    logger.info(f'{len(results) - failed} of {len(results)} jobs submitted, results saved to {args.output}')
+    sys.exit(1 if failed else 0)
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--batch':
+        batch_main(sys.argv[2:])
     Client = SetSettings()
     Client.open_connection()
     upload_directory(Client)
     create_link(Client)
     copy_source(Client)
-    config_multiplier(Client)
+    if not Client.PIPELINE:
+        config_multiplier(Client)
     launch_runme(Client)
     get_jobs_ids(Client)
     Client.close_connection()